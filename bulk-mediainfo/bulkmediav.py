@@ -9,6 +9,9 @@ from fractions import Fraction
 import threading
 import subprocess
 import json
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
 import multiprocessing as mp
 from tqdm import tqdm
 import signal
@@ -46,15 +49,59 @@ cpu_total = os.cpu_count() or 4
 workers = max(1, int(cpu_total * 0.4))
 
 
+def get_probe_cache_path():
+    """Location of the probe cache shared by all media-toolbox tools."""
+    cache_dir = os.environ.get("MEDIA_TOOLBOX_CACHE")
+    if not cache_dir:
+        if platform.system() == "Windows":
+            cache_dir = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "media-toolbox")
+        else:
+            cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                     "media-toolbox")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, "probe-cache.sqlite3")
+
+
+@lru_cache(maxsize=None)
+def init_probe_cache():
+    """Create the probe cache database and its table, once per process. Returns its path."""
+    path = get_probe_cache_path()
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                     "mtime_ns INTEGER NOT NULL, data TEXT NOT NULL)")
+    return path
+
+
+def probe_file(path):
+    """
+    ffprobe streams/format/chapters for `path` as a dict. Results are cached
+    on disk and reused until the file's size or mtime changes. Raises
+    CalledProcessError if ffprobe fails.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with closing(sqlite3.connect(init_probe_cache(), timeout=30)) as conn:
+        row = conn.execute("SELECT size, mtime_ns, data FROM probes WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return json.loads(row[2])
+
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-show_streams", "-show_format", "-show_chapters",
+            "-of", "json", path
+        ]
+        output = subprocess.check_output(cmd).decode("utf-8", errors="ignore")
+        data = json.loads(output)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)",
+                         (path, st.st_size, st.st_mtime_ns, output))
+        return data
+
+
 def get_video_info_ffprobe(path):
-    cmd = [
-        "ffprobe", "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height,duration:format=duration",
-        "-of", "json", path
-    ]
-    data = json.loads(subprocess.check_output(cmd))
-    s = data["streams"][0]
+    data = probe_file(path)
+    s = [st for st in data["streams"] if st.get("codec_type") == "video"][0]
 
     w = int(s["width"])
     h = int(s["height"])
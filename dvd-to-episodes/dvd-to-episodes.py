@@ -5,6 +5,9 @@ import shutil
 import math
 import datetime
 import platform
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
 from prompt_toolkit import prompt
 
 
@@ -41,23 +44,64 @@ def convert_size(size_bytes):
     return f"{s} {size_name[i]}"
 
 
+def get_probe_cache_path():
+    """Location of the probe cache shared by all media-toolbox tools."""
+    cache_dir = os.environ.get('MEDIA_TOOLBOX_CACHE')
+    if not cache_dir:
+        if platform.system() == "Windows":
+            cache_dir = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), 'media-toolbox')
+        else:
+            cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                     'media-toolbox')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, 'probe-cache.sqlite3')
+
+
+@lru_cache(maxsize=None)
+def init_probe_cache():
+    """Create the probe cache database and its table, once per process. Returns its path."""
+    path = get_probe_cache_path()
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS probes ('
+                     'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, data TEXT NOT NULL)')
+    return path
+
+
+def probe_file(filename):
+    """
+    ffprobe streams/format/chapters of a file as a dict ({} on failure).
+    Cached on disk and reused until the file's size or mtime changes.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    with closing(sqlite3.connect(init_probe_cache(), timeout=30)) as conn:
+        row = conn.execute('SELECT size, mtime_ns, data FROM probes WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return json.loads(row[2])
+
+        command = [ffprobe, "-v", "error", "-show_streams", "-show_format", "-show_chapters",
+                   "-print_format", "json", path]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+        try:
+            probe = json.loads(result.stdout)
+        except json.JSONDecodeError:
+            return {}
+        if result.returncode != 0:
+            return {}
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime_ns, result.stdout))
+        return probe
+
+
 def get_file_duration(filename):
-    result = subprocess.run([ffprobe, "-v", "error", "-show_entries",
-                             "format=duration", "-of",
-                             "default=noprint_wrappers=1:nokey=1", filename],
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    duration = float(result.stdout)
+    duration = float(probe_file(filename).get("format", {}).get("duration", 0))
     return str(datetime.timedelta(seconds=int(duration)))
 
 
 def get_number_of_chapters(filename):
-    command = [ffprobe, "-print_format", "json", "-show_chapters", "-loglevel", "error", filename]
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8')
-    try:
-        chapters_info = json.loads(result.stdout)
-        return len(chapters_info.get("chapters", []))
-    except json.JSONDecodeError:
-        return 0
+    return len(probe_file(filename).get("chapters", []))
 
 
 def list_mkvs(directory, processed_files):
@@ -2,69 +2,781 @@ import os
 import subprocess
 import sys
 import re
+import json
+import sqlite3
 import shutil  # Added to enable directory removal
 import platform
+import argparse
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import csv
+import hashlib
+from collections import Counter
+from contextlib import closing
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from prompt_toolkit import prompt
-from better_ffmpeg_progress import FfmpegProcess
 from rich.console import Console
+from rich.table import Table
+from rich.live import Live
+from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn, \
+    TimeElapsedColumn, TimeRemainingColumn
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    tomllib = None
 
 # Calculate max_workers as 85% of the available logical cores
 max_cpu_usage = 85
 max_workers = int(os.cpu_count() * int(max_cpu_usage) / 100)
 
+# Number of spread-out timestamps sampled for automatic crop detection,
+# and the number of frames cropdetect looks at per sample
+auto_crop_samples = 8
+auto_crop_frames = 6
+# Number of episodes measured per season when sharing crop values within a folder
+auto_crop_group_samples = 3
+
+# Target-quality CRF search ('auto' quality): number and length (seconds) of the sample
+# clips, and the number of CRF values tried in parallel per search round
+crf_search_samples = 3
+crf_search_sample_length = 10
+crf_search_candidates = 3
+# CRF range searched per codec, and the default target score per metric
+crf_search_ranges = {
+    'libx264': (12, 30),
+    'libx265': (12, 30),
+    'libvpx-vp9': (15, 50),
+    'libaom-av1': (15, 50)
+}
+crf_search_targets = {
+    'vmaf': 95.0,
+    'ssim': 0.985
+}
+
+# Size check: number and length (seconds) of the clips encoded to predict the output size.
+# During the encode, the running size is judged once both this many seconds and this share
+# of the file are encoded, and the encode stops if it is on course to pass the source size
+# by the margin.
+size_check_samples = 4
+size_check_sample_length = 10
+size_abort_min_seconds = 60
+size_abort_fraction = 0.15
+size_abort_margin = 1.05
+
+# Disk space admission control: rough size of the encoded video relative to the source
+# video at CRF 18, halving for every 6 CRF steps above it. Estimates get a safety margin,
+# and the given amount of space is always left free.
+output_size_ratios = {
+    'libx264': 0.6,
+    'libx265': 0.4,
+    'libvpx-vp9': 0.4,
+    'libaom-av1': 0.3
+}
+output_size_margin = 1.25
+disk_space_reserve = 2 * 1024 ** 3
+# Seconds between free space checks while nothing is running to free up space
+disk_space_poll_interval = 30
+
 if platform.system() == "Windows":
     # Update PATH to point to FFmpeg in bin folder if running Windows.
-    # Needed for better-ffmpeg-progress to work properly.
     ffmpeg_dir = os.path.abspath(r'.bin\ffmpeg')
     os.environ["PATH"] = os.pathsep.join([ffmpeg_dir, os.environ.get("PATH", "")])
     ffmpeg = r'.bin\ffmpeg\ffmpeg.exe'
     ffprobe = r'.bin\ffmpeg\ffprobe.exe'
     mkvmerge = r'.bin\mkvtoolnix\mkvmerge.exe'
-    handbrake = r'.bin\handbrake\HandBrakeCLI.exe'
 else:
     ffmpeg = 'ffmpeg'
     ffprobe = 'ffprobe'
     mkvmerge = 'mkvmerge'
-    handbrake = 'HandBrakeCLI'
+
+console = Console()
+# Serializes directory removal when several jobs finish at the same time
+cleanup_lock = threading.Lock()
+
+# Map user-friendly codec names to ffmpeg encoder names
+codec_map = {
+    'h264': 'libx264',
+    'h265': 'libx265',
+    'hevc': 'libx265',
+    'vp9': 'libvpx-vp9',
+    'av1': 'libaom-av1'
+}
+
+# Map codec to available tune options
+codec_tune_options = {
+    'libx264': ['film', 'animation', 'grain', 'stillimage', 'fastdecode', 'zerolatency', 'psnr', 'ssim'],
+    'libx265': ['grain', 'fastdecode', 'zerolatency', 'psnr', 'ssim', 'animation'],
+    'libvpx-vp9': [],
+    'libaom-av1': ['ssim', 'psnr']
+}
+
+# Determine codec display name for filename replacements
+codec_display_name_map = {
+    'libx264': 'x264',
+    'libx265': 'x265',
+    'libvpx-vp9': 'VP9',
+    'libaom-av1': 'AV1'
+}
+
+# Number of encoder threads a single FFmpeg instance can keep busy before scaling
+# flattens out. On machines with more cores than this, running several files at
+# once is faster than giving one encode every core.
+codec_thread_limits = {
+    'libx264': 16,
+    'libx265': 16,
+    'libvpx-vp9': 8,
+    'libaom-av1': 8
+}
+
+# Encoder benchmark (--benchmark): a synthetic 1080p clip with film-like grain, encoded with
+# every thread/job configuration. The first speed of each codec is used for the tuning,
+# the others are only measured for comparison.
+benchmark_source = 'testsrc2=size=1920x1080:rate=24,noise=alls=12:allf=t+u:all_seed=1234,format=yuv420p'
+benchmark_frames = 120
+benchmark_codecs = ['libx264', 'libx265']
+benchmark_speeds = {
+    'libx264': ['medium', 'slow'],
+    'libx265': ['medium', 'slow'],
+    'libvpx-vp9': ['4'],
+    'libaom-av1': ['4']
+}
+# Benchmark results used instead of the built-in thread heuristics, kept next to the probe cache
+encoder_tuning_file = 'encoder-tuning.json'
+
+# Audio and subtitle codecs FFmpeg can stream copy into Matroska. Files with any other
+# stream (e.g. mov_text subtitles from MP4, data tracks) are merged with mkvmerge instead.
+direct_mux_codecs = {
+    'audio': ['aac', 'ac3', 'eac3', 'dts', 'truehd', 'flac', 'opus', 'vorbis', 'mp3', 'mp2',
+              'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le'],
+    'subtitle': ['subrip', 'ass', 'ssa', 'hdmv_pgs_subtitle', 'dvd_subtitle', 'webvtt'],
+}
+
+# Optional audio stage: source audio codecs worth transcoding (lossless and DTS, matched on
+# the part of the codec name before any '_', e.g. pcm_s24le), the encoder per target codec
+# and the bitrate in kbit/s per channel count. Other channel counts get the per-channel rate.
+audio_transcode_sources = ['truehd', 'mlp', 'dts', 'flac', 'alac', 'pcm']
+audio_encoders = {'opus': 'libopus', 'aac': 'aac'}
+audio_bitrates = {
+    'opus': {1: 96, 2: 128, 6: 320, 8: 448},
+    'aac': {1: 96, 2: 192, 6: 448, 8: 576},
+}
+audio_bitrate_per_channel = {'opus': 64, 'aac': 80}
+
+# Options of a profile in profile mode and their defaults. The values use the same
+# format as the answers to the interactive prompts.
+profile_defaults = {
+    'crop': 'auto',  # 'auto', 'group', 'none' or 'left,right,top,bottom'
+    'resolution': '',  # '', '1080p', '720p' or 'WIDTHxHEIGHT'
+    'codec': 'h265',
+    'quality': 18,  # CRF, or 'auto' to search for the CRF meeting quality_target
+    'quality_metric': 'vmaf',  # 'vmaf' or 'ssim'
+    'quality_target': '',  # Empty for the default target of the metric
+    'tune': '',
+    'speed': '',  # Empty for the recommended speed of the codec/tune
+    'cpu_usage': 'auto',
+    'concurrent_jobs': 'auto',
+    'segment_length': 0,  # Chunk length in seconds, 0 disables chunked encoding
+    'segment_jobs': 'auto',
+    'direct_mux': True,
+    'min_savings': 0,  # Percent; files predicted to shrink less are handled per size_check, 0 disables
+    'size_check': 'skip',  # 'skip' or 'flag' (encode anyway, with a warning)
+    'audio_codec': '',  # '' keeps all audio as it is, 'opus' or 'aac' transcodes lossless and DTS tracks
+    'custom_params': '',
+    'ui': 'quiet',
+    'queue_order': 'natural',  # 'natural', 'shortest', 'priority' or 'fair', see EncodeQueue
+}
+# Journal of the files in progress, kept in the output folder
+journal_file = '.media-encoder-journal.json'
+# Worker mode: claims on the files being encoded, kept in the shared input folder
+lease_dir = '.leases'
+# Seconds between lease renewals, and without a visible renewal before a lease is taken over
+lease_heartbeat_interval = 30
+lease_timeout = 300
+# Per-file throughput log, kept in the output folder. A '.csv' path writes CSV instead of JSON lines.
+metrics_log_file = '.media-encoder-metrics.jsonl'
+metrics_fields = ['finished', 'file', 'status', 'codec', 'preset', 'crf', 'tune', 'threads', 'segmented',
+                  'duration', 'wall_time', 'encode_time', 'cpu_time', 'frames', 'fps', 'speed',
+                  'predicted_size', 'output_size', 'output_bitrate_kbps']
+# Per-directory override file in profile mode, applies to the folder and its subfolders
+directory_override_file = '.media-encoder.toml'
+# Scheduling policies of the encode queue, and the file in the input folder to pin files
+# and set folder priorities while the queue runs
+queue_orders = ['natural', 'shortest', 'priority', 'fair']
+queue_control_file = '.media-encoder-queue.toml'
+
+# Substrings to replace with codec_display_name
+replace_substrings = ['HEVC', 'AVC', 'H.265', 'H.264', 'h264', 'h265', 'x264', 'x265', 'VC-1']
+# Substrings to remove
+remove_substrings = ['.REMUX', ' REMUX', 'REMUX']
+# Optional TOML file with extra output naming rules, see NamingRules.load()
+naming_rules_file = 'naming-rules.toml'
+
+
+class NamingRules:
+    """
+    Case-insensitive substring rewrite rules for file names, compiled once into a single
+    alternation so a name is rewritten in one scan however many rules there are. Longer
+    substrings are tried first, so '.REMUX' wins over 'REMUX'. A '{codec}' in a replacement
+    is filled in per call.
+    """
+
+    def __init__(self, replacements):
+        replacements = {substring: replacement for substring, replacement in replacements.items() if substring}
+        self.replacements = {substring.lower(): replacement for substring, replacement in replacements.items()}
+        substrings = sorted(replacements, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(s) for s in substrings), re.IGNORECASE) if substrings else None
+
+    @classmethod
+    def load(cls, rules_file=None):
+        """
+        The built-in rules plus those from rules_file, a TOML file like:
+
+            remove = ["WEB-DL"]
+
+            [replace]
+            "10bit" = "10-bit"
+            "XviD" = "{codec}"
+
+        Rules from the file override built-in rules for the same substring.
+        """
+        replacements = {s: '{codec}' for s in replace_substrings}
+        replacements.update((s, '') for s in remove_substrings)
+        if rules_file:
+            if tomllib is None:
+                print("Naming rules files require Python 3.11 or newer (tomllib).")
+                sys.exit(1)
+            try:
+                with open(rules_file, 'rb') as f:
+                    rules = tomllib.load(f)
+            except (OSError, tomllib.TOMLDecodeError) as e:
+                print(f"Unable to read naming rules file '{rules_file}': {e}")
+                sys.exit(1)
+            replacements.update((s, '') for s in rules.get('remove', []))
+            replacements.update((s, str(r)) for s, r in rules.get('replace', {}).items())
+        return cls(replacements)
+
+    def apply(self, name, codec=''):
+        if self.pattern is None:
+            return name
+        return self.pattern.sub(lambda m: self.replacements[m.group(0).lower()].replace('{codec}', codec), name)
+
+
+# Rules used for output names, replaced by main() when a rules file is found
+output_naming = NamingRules.load()
+
+
+def get_probe_cache_path():
+    """Location of the probe cache shared by all media-toolbox tools."""
+    cache_dir = os.environ.get('MEDIA_TOOLBOX_CACHE')
+    if not cache_dir:
+        if platform.system() == "Windows":
+            cache_dir = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), 'media-toolbox')
+        else:
+            cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                     'media-toolbox')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, 'probe-cache.sqlite3')
+
+
+@lru_cache(maxsize=None)
+def init_probe_cache():
+    """Create the probe cache database and its tables, once per process. Returns its path."""
+    path = get_probe_cache_path()
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        # WAL mode is stored in the database file, so it only needs setting once
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS probes ('
+                     'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, data TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS auto_crops ('
+                     'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, value TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS crf_choices ('
+                     'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, value TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS show_crfs ('
+                     'show TEXT NOT NULL, params TEXT NOT NULL, crf INTEGER NOT NULL, PRIMARY KEY (show, params))')
+    return path
+
+
+def open_probe_cache():
+    return sqlite3.connect(init_probe_cache(), timeout=30)
+
+
+def probe_file(filename):
+    """
+    Return the ffprobe streams/format/chapters of a file as a dict, or None on failure.
+    Results are cached on disk and reused until the file's size or mtime changes.
+    """
+    path = os.path.abspath(filename)
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        print(f"Error probing {filename}: {e}")
+        return None
+
+    with closing(open_probe_cache()) as conn:
+        row = conn.execute('SELECT size, mtime_ns, data FROM probes WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return json.loads(row[2])
+
+        cmd = [ffprobe, '-v', 'error', '-show_streams', '-show_format', '-show_chapters', '-of', 'json', path]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            print(f"Error probing {filename}: {result.stderr}")
+            return None
+        try:
+            probe = json.loads(result.stdout)
+        except ValueError:
+            print(f"Error parsing ffprobe output for {filename}: {result.stdout}")
+            return None
+
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime_ns, result.stdout))
+        return probe
 
 
 def get_video_dimensions(filename):
-    cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0',
-           '-show_entries', 'stream=width,height', '-of', 'csv=p=0:s=x', filename]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Error getting video dimensions for {filename}: {result.stderr}")
+    probe = probe_file(filename)
+    if probe is None:
+        print(f"Error getting video dimensions for {filename}")
         return None, None
+    video_streams = [s for s in probe.get('streams', []) if s.get('codec_type') == 'video']
     try:
-        # Strip any trailing 'x' and whitespace
-        output = result.stdout.strip().rstrip('x')
-        width, height = map(int, output.split('x'))
-        return width, height
-    except ValueError:
-        print(f"Error parsing video dimensions for {filename}: {result.stdout}")
+        return int(video_streams[0]['width']), int(video_streams[0]['height'])
+    except (IndexError, KeyError, ValueError):
+        print(f"Error parsing video dimensions for {filename}")
         return None, None
 
 
+def get_media_duration(filename):
+    """Duration of a file in seconds from the probe cache, or None if unknown."""
+    probe = probe_file(filename)
+    try:
+        return float(probe['format']['duration'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def get_cached_value(table, filename):
+    """Look up a per-file result (e.g. auto-crop values) stored next to the probe cache."""
+    path = os.path.abspath(filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with closing(open_probe_cache()) as conn:
+        row = conn.execute(f'SELECT size, mtime_ns, value FROM {table} WHERE path = ?', (path,)).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return row[2]
+    return None
+
+
+def set_cached_value(table, filename, value):
+    path = os.path.abspath(filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    with closing(open_probe_cache()) as conn, conn:
+        conn.execute(f'INSERT OR REPLACE INTO {table} (path, size, mtime_ns, value) VALUES (?, ?, ?, ?)',
+                     (path, stat.st_size, stat.st_mtime_ns, value))
+
+
+def detect_crop_at(file, timestamp):
+    """Run FFmpeg's cropdetect on a few frames at timestamp. Returns (w, h, x, y) or None."""
+    cmd = [ffmpeg, '-hide_banner', '-nostats', '-ss', f'{timestamp:.3f}', '-i', file,
+           '-map', '0:v:0', '-an', '-sn', '-frames:v', str(auto_crop_frames),
+           '-vf', 'cropdetect=limit=0.094:round=2:reset=0', '-f', 'null', '-']
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    matches = re.findall(r'crop=(-?\d+):(-?\d+):(-?\d+):(-?\d+)', result.stderr)
+    if not matches:
+        return None
+    w, h, x, y = map(int, matches[-1])
+    if w <= 0 or h <= 0 or x < 0 or y < 0:
+        # Completely black frames give no usable crop
+        return None
+    return w, h, x, y
+
+
 def auto_crop(file):
+    """
+    Detect black bars by sampling a few frames at spread-out timestamps with FFmpeg's cropdetect.
+    The samples run in parallel, and the result is cached per file until the file changes.
+    """
+    cached = get_cached_value('auto_crops', file)
+    if cached is not None:
+        return cached
+
     try:
-        hb_output = subprocess.check_output(f'"{handbrake}" -i "{file}" --scan -t 0', stderr=subprocess.STDOUT,
-                                            shell=True).decode()
-        autocrop_str = re.search(r"\+ autocrop: (.+)", hb_output).group(1)
-        top, bottom, left, right = map(int, autocrop_str.split('/'))
+        orig_width, orig_height = get_video_dimensions(file)
+        duration = float(probe_file(file)['format']['duration'])
+        timestamps = [duration * (i + 1) / (auto_crop_samples + 1) for i in range(auto_crop_samples)]
+        with ThreadPoolExecutor(max_workers=max(1, min(auto_crop_samples, max_workers))) as executor:
+            samples = [c for c in executor.map(lambda t: detect_crop_at(file, t), timestamps) if c]
+        if not samples:
+            return f"0,0,0,0"
+
+        # Keep the largest picture area seen in any sample, so dark scenes never crop away content
+        left = min(x for w, h, x, y in samples)
+        top = min(y for w, h, x, y in samples)
+        right = min(orig_width - w - x for w, h, x, y in samples)
+        bottom = min(orig_height - h - y for w, h, x, y in samples)
 
         # Ensure values are multiples of 4
-        top = 4 * (top // 4)
-        bottom = 4 * (bottom // 4)
-        left = 4 * (left // 4)
-        right = 4 * (right // 4)
-
-        return f"{left},{right},{top},{bottom}"
+        top = 4 * (max(0, top) // 4)
+        bottom = 4 * (max(0, bottom) // 4)
+        left = 4 * (max(0, left) // 4)
+        right = 4 * (max(0, right) // 4)
+
+        crop_values = f"{left},{right},{top},{bottom}"
+        set_cached_value('auto_crops', file, crop_values)
+        return crop_values
     except Exception as e:
         return f"0,0,0,0"
 
 
+class CropGroups:
+    """
+    Shares crop values within groups of files with the same folder and resolution (typically
+    a season). Files are added as they show up in the queue, and the crop of a file is looked
+    up by its job once it starts, so measuring never holds up the queue. Once a group has
+    enough files, a few evenly spaced episodes are measured, and if most of them agree, that
+    crop is used for the rest of the group. Measurements are kept across batches, so episodes
+    that arrive one at a time still reach a consensus after the first few. Groups without a
+    consensus, and files whose resolution differs from the rest of their folder, fall back to
+    measuring each file.
+    """
+
+    def __init__(self):
+        self.files = set()
+        # group -> consensus crop, and group -> {file: measured crop}
+        self.profiles = {}
+        self.measured = {}
+        self.lock = threading.Lock()
+        self.group_locks = {}
+
+    def add(self, media_files):
+        with self.lock:
+            self.files.update(media_files)
+
+    def remove(self, media_file):
+        with self.lock:
+            self.files.discard(media_file)
+
+    @staticmethod
+    def _group_key(media_file):
+        width, height = get_video_dimensions(media_file)
+        if width is None or height is None:
+            return None
+        return os.path.dirname(media_file), width, height
+
+    def _consensus(self, group_key):
+        crops = self.measured.get(group_key, {})
+        if len(crops) < auto_crop_group_samples:
+            return None
+        consensus, votes = Counter(crops.values()).most_common(1)[0]
+        return consensus if votes * 2 > len(crops) else None
+
+    def crop_for(self, media_file):
+        """Return the crop values string for media_file, measuring it or its group's samples if needed."""
+        group_key = self._group_key(media_file)
+        if group_key is None:
+            return auto_crop(media_file)
+        with self.lock:
+            group_lock = self.group_locks.setdefault(group_key, threading.Lock())
+            folder_files = [f for f in self.files if os.path.dirname(f) == group_key[0]]
+
+        # One job measures a group at a time, so the samples are never measured twice
+        with group_lock:
+            measured = self.measured.setdefault(group_key, {})
+            if media_file in measured:
+                return measured[media_file]
+            if group_key in self.profiles:
+                return self.profiles[group_key]
+
+            group_files = sorted({f for f in folder_files if self._group_key(f) == group_key} | set(measured)
+                                 | {media_file}, key=natural_sort_key)
+            if len(group_files) > auto_crop_group_samples and len(measured) < auto_crop_group_samples:
+                step = len(group_files) / auto_crop_group_samples
+                sample_files = [group_files[int(step * i + step / 2)] for i in range(auto_crop_group_samples)]
+                for sample_file in sample_files:
+                    if len(measured) >= auto_crop_group_samples:
+                        break
+                    if sample_file not in measured and os.path.exists(sample_file):
+                        measured[sample_file] = auto_crop(sample_file)
+
+            consensus = self._consensus(group_key)
+            if consensus is None:
+                measured[media_file] = auto_crop(media_file)
+                # Later files of the group can use the consensus once enough of them are measured
+                consensus = self._consensus(group_key)
+            if consensus is not None:
+                self.profiles[group_key] = consensus
+                console.print(f"Using crop {consensus} for the rest of the files in "
+                              f"'{group_key[0]}' ({group_key[1]}x{group_key[2]})", highlight=False)
+            return measured.get(media_file, consensus)
+
+
+ffmpeg_filters = None
+
+
+def ffmpeg_has_filter(name):
+    """Whether the FFmpeg build provides the given filter (e.g. libvmaf, which is optional)."""
+    global ffmpeg_filters
+    if ffmpeg_filters is None:
+        try:
+            result = subprocess.run([ffmpeg, '-hide_banner', '-filters'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, text=True, errors='replace')
+            ffmpeg_filters = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 2}
+        except OSError:
+            ffmpeg_filters = set()
+    return name in ffmpeg_filters
+
+
+def extract_reference_sample(media_file, sample_file, timestamp, length, filter_str):
+    """Cut a lossless (FFV1) clip with the crop/scale already applied, to encode and score against."""
+    cmd = [ffmpeg, '-y', '-hide_banner', '-nostats', '-loglevel', 'error',
+           '-ss', f'{timestamp:.3f}', '-i', media_file, '-t', f'{length:.3f}',
+           '-map', '0:v:0', '-an', '-sn', '-dn']
+    if filter_str:
+        cmd.extend(['-vf', filter_str])
+    cmd.extend(['-c:v', 'ffv1', '-level', '3', sample_file])
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"Error extracting sample at {timestamp:.0f}s:\n{result.stderr}")
+
+
+def score_sample(encoded_file, reference_file, metric, number_of_threads):
+    """Score an encoded sample against its reference with libvmaf (0-100) or ssim (0-1)."""
+    if metric == 'vmaf':
+        compare = f'libvmaf=n_threads={max(1, number_of_threads)}'
+        pattern = r'VMAF score[:=]\s*([\d.]+)'
+    else:
+        compare = 'ssim'
+        pattern = r'All:([\d.]+)'
+    cmd = [ffmpeg, '-hide_banner', '-nostats', '-i', encoded_file, '-i', reference_file,
+           '-lavfi', f'[0:v]setpts=PTS-STARTPTS[dist];[1:v]setpts=PTS-STARTPTS[ref];[dist][ref]{compare}',
+           '-f', 'null', '-']
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    matches = re.findall(pattern, result.stderr)
+    if result.returncode != 0 or not matches:
+        raise RuntimeError(f"Error scoring '{encoded_file}' with {metric}:\n{result.stderr[-2000:]}")
+    return float(matches[-1])
+
+
+def crf_search_params(settings, filter_str=None):
+    """Key of everything that affects the chosen CRF, so cached choices are only reused for the same search."""
+    params = [settings['codec'], settings['encoder_speed'], settings['tune_option'], settings['quality_metric'],
+              str(settings['quality_target']), settings['user_custom_ffmpeg'].strip()]
+    if filter_str is not None:
+        params.append(filter_str)
+    return '|'.join(params)
+
+
+def search_crf(media_file, filter_str, settings, work_dir):
+    """
+    Find the highest CRF whose encode still meets settings['quality_target']. A few sample
+    clips are encoded at several candidate CRFs in parallel and scored with libvmaf or ssim;
+    a CRF passes when every sample meets the target. Each round narrows the range to the gap
+    between the last passing and the first failing candidate, assuming the score drops as
+    the CRF goes up. The CRF found earlier for the same folder (show/season) is tried first.
+    Returns (crf, score), or (None, None) if the samples could not be encoded or scored.
+    """
+    metric = settings['quality_metric']
+    target = settings['quality_target']
+    crf_min, crf_max = crf_search_ranges.get(settings['codec'], (12, 30))
+    show = os.path.dirname(os.path.abspath(media_file))
+    show_params = crf_search_params(settings)
+
+    duration = get_media_duration(media_file)
+    if not duration:
+        return None, None
+    sample_length = min(crf_search_sample_length, duration / crf_search_samples)
+    timestamps = [duration * (i + 1) / (crf_search_samples + 1) - sample_length / 2
+                  for i in range(crf_search_samples)]
+
+    # The search jobs share the machine with the other running encodes
+    search_workers = max(1, max_workers // settings['concurrent_jobs'])
+    number_of_threads = calculate_encoder_threads(settings['codec'], settings['cpu_usage_percentage'],
+                                                  search_workers)
+
+    os.makedirs(work_dir, exist_ok=True)
+    references = [os.path.join(work_dir, f'reference_{i}.mkv') for i in range(len(timestamps))]
+    try:
+        with ThreadPoolExecutor(max_workers=min(search_workers, len(timestamps))) as executor:
+            list(executor.map(lambda args: extract_reference_sample(media_file, args[0], args[1], sample_length,
+                                                                    filter_str),
+                              zip(references, timestamps)))
+    except RuntimeError as e:
+        print(f"CRF search failed for '{media_file}': {e}")
+        return None, None
+
+    def encode_and_score(crf, reference):
+        encoded_file = os.path.join(work_dir, f'crf{crf}_' + os.path.basename(reference))
+        cmd_ffmpeg = build_ffmpeg_command(reference, encoded_file, None, {**settings, 'quality': str(crf)},
+                                          number_of_threads)
+        cmd_ffmpeg = cmd_ffmpeg[:1] + ['-nostats', '-loglevel', 'error'] + cmd_ffmpeg[1:]
+        result = subprocess.run(cmd_ffmpeg, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Error encoding sample at CRF {crf}:\n{result.stderr}")
+        score = score_sample(encoded_file, reference, metric, number_of_threads)
+        os.remove(encoded_file)
+        return score
+
+    scores = {}
+
+    def spread(low, high):
+        return [low + round((high - low) * (i + 1) / (crf_search_candidates + 1))
+                for i in range(crf_search_candidates)]
+
+    # low is the highest CRF known to pass and high the lowest known to fail. Both start
+    # just outside the range, so the result is clamped to it.
+    low, high = crf_min - 1, crf_max + 1
+    with closing(open_probe_cache()) as conn:
+        row = conn.execute('SELECT crf FROM show_crfs WHERE show = ? AND params = ?', (show, show_params)).fetchone()
+    candidates = [row[0], row[0] + 1] if row else spread(low, high)
+
+    try:
+        with ThreadPoolExecutor(max_workers=search_workers) as executor:
+            while True:
+                candidates = sorted({c for c in candidates if low < c < high and c not in scores})
+                if not candidates:
+                    break
+                futures = {(crf, reference): executor.submit(encode_and_score, crf, reference)
+                           for crf in candidates for reference in references}
+                for crf in candidates:
+                    scores[crf] = min(futures[(crf, reference)].result() for reference in references)
+                high = min([high] + [c for c in candidates if scores[c] < target])
+                low = max([low] + [c for c in candidates if c < high and scores[c] >= target])
+                if high - low <= 1:
+                    break
+                candidates = spread(low, high)
+    except RuntimeError as e:
+        print(f"CRF search failed for '{media_file}': {e}")
+        return None, None
+
+    if low < crf_min:
+        # Not even the lowest CRF meets the target, so use the best quality in the range
+        crf = crf_min
+    else:
+        crf = low
+    with closing(open_probe_cache()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO show_crfs (show, params, crf) VALUES (?, ?, ?)', (show, show_params, crf))
+    return crf, scores.get(crf)
+
+
+def choose_crf(media_file, filter_str, settings, work_dir):
+    """The CRF to encode media_file with in 'auto' quality mode, cached per file. Returns None on failure."""
+    params = crf_search_params(settings, filter_str or '')
+    cached = get_cached_value('crf_choices', media_file)
+    if cached is not None:
+        choice = json.loads(cached)
+        if choice.get('params') == params:
+            return choice['crf']
+
+    name = os.path.basename(media_file)
+    console.print(f"Searching CRF for {name} ({settings['quality_metric'].upper()} "
+                  f"target {settings['quality_target']})", highlight=False)
+    try:
+        crf, score = search_crf(media_file, filter_str, settings, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if crf is None:
+        return None
+    score_text = f"{score:.3f}" if score is not None else "below target"
+    console.print(f"Selected CRF {crf} for {name} ({settings['quality_metric'].upper()} {score_text})",
+                  highlight=False)
+    set_cached_value('crf_choices', media_file, json.dumps({'params': params, 'crf': crf, 'score': score}))
+    return crf
+
+
+def get_non_video_bytes(media_file, audio_codec=''):
+    """
+    Size of the audio, subtitle and other non-video streams of the source. Uses the stream
+    statistics tags written by mkvmerge, or the stream bitrate; streams without either count as 0.
+    With audio_codec, the tracks the audio stage would transcode count at their new bitrate.
+    """
+    probe = probe_file(media_file) or {}
+    duration = get_media_duration(media_file) or 0
+    total = 0
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            continue
+        if audio_codec and is_audio_transcoded(stream):
+            total += get_audio_bitrate(audio_codec, stream.get('channels')) * 1000 * duration / 8
+            continue
+        tags = stream.get('tags', {})
+        number_of_bytes = next((v for k, v in tags.items() if k.upper().startswith('NUMBER_OF_BYTES')), None)
+        try:
+            if number_of_bytes is not None:
+                total += int(number_of_bytes)
+            elif stream.get('bit_rate'):
+                total += int(stream['bit_rate']) * duration / 8
+        except ValueError:
+            continue
+    return total
+
+
+def predict_output_size(media_file, filter_str, settings, work_dir):
+    """
+    Predict the size of the finished file by encoding a few short clips from across the
+    source with the final settings, extrapolating their bitrate to the whole duration and
+    adding the streams that are copied as they are. Returns the size in bytes, or None.
+    """
+    duration = get_media_duration(media_file)
+    if not duration:
+        return None
+    sample_length = min(size_check_sample_length, duration / size_check_samples)
+    timestamps = [duration * (i + 1) / (size_check_samples + 1) - sample_length / 2
+                  for i in range(size_check_samples)]
+
+    search_workers = max(1, min(size_check_samples, max_workers // settings['concurrent_jobs']))
+    number_of_threads = calculate_encoder_threads(settings['codec'], settings['cpu_usage_percentage'],
+                                                  search_workers)
+
+    def encode_sample(index, timestamp):
+        sample_file = os.path.join(work_dir, f'sample_{index}.mkv')
+        cmd_ffmpeg = build_ffmpeg_command(media_file, sample_file, filter_str, settings, number_of_threads)
+        input_index = cmd_ffmpeg.index('-i')
+        cmd_ffmpeg[input_index:input_index + 2] = ['-ss', f'{timestamp:.3f}', '-i', media_file,
+                                                   '-t', f'{sample_length:.3f}']
+        cmd_ffmpeg = cmd_ffmpeg[:1] + ['-nostats', '-loglevel', 'error'] + cmd_ffmpeg[1:]
+        result = subprocess.run(cmd_ffmpeg, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Error encoding sample at {timestamp:.0f}s:\n{result.stderr}")
+        return os.path.getsize(sample_file)
+
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        with ThreadPoolExecutor(max_workers=search_workers) as executor:
+            sample_sizes = list(executor.map(encode_sample, range(len(timestamps)), timestamps))
+    except (RuntimeError, OSError) as e:
+        print(f"Unable to predict the output size of '{media_file}': {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    video_bytes_per_second = sum(sample_sizes) / (sample_length * len(sample_sizes))
+    return video_bytes_per_second * duration + get_non_video_bytes(media_file, settings['audio_codec'])
+
+
+def skip_media_file(media_file, reason, journal=None, job=None):
+    """Leave a file in the input folder without encoding it. Returns False like a failed encode."""
+    console.print(f"Skipping {os.path.basename(media_file)}: {reason}", style="yellow", highlight=False)
+    if journal:
+        journal.update(media_file, 'skipped', reason=reason, temp_files=[], chunk_dir=None, output_file=None)
+    if job:
+        job.skipped = reason
+    return False
+
+
 def get_all_files(path):
     files = []
     for dirpath, dirnames, filenames in os.walk(path):
@@ -74,59 +786,186 @@ def get_all_files(path):
     return files
 
 
-def wait_for_stable_files(path):
-    def is_file_stable(file_path):
-        """Check if a file's size is stable (indicating it is fully copied)."""
-        initial_size = os.path.getsize(file_path)
-        time.sleep(2.5)
-        new_size = os.path.getsize(file_path)
-        return initial_size == new_size
-
-    stable_files = set()
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                      IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
 
-    while True:
-        # Get the current list of files to check
-        files = []
-        for dirpath, dirnames, filenames in os.walk(path):
-            # Modify dirnames in-place to skip directories starting with a dot
-            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
-            files.extend(os.path.join(dirpath, f) for f in filenames if not f.startswith('.'))
 
-        def process_file(file_path):
-            if file_path in stable_files:
-                return None  # Skip already stable files
-            if is_file_stable(file_path):
-                return file_path  # Return stable file
-            return None
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_file = {executor.submit(process_file, file): file for file in files if file not in stable_files}
-
-            for future in as_completed(future_to_file):
-                result = future.result()
-                if result:
-                    stable_files.add(result)
+class InputWatcher:
+    """
+    Keeps an in-memory index of the files in the input folder and reports each file
+    once it is fully copied. On Linux, inotify close-write/move events tell us when
+    a copy has finished. Elsewhere (or if inotify is unavailable) the tree is walked
+    once per poll, and a file counts as stable once its size and modification time
+    haven't changed for settle_time seconds.
+    """
 
-        # Check again
-        time.sleep(2.5)
-        files = []
-        for dirpath, dirnames, filenames in os.walk(path):
+    def __init__(self, path, settle_time=2.5):
+        self.path = path
+        self.settle_time = settle_time
+        # file path -> [size, mtime, time of last change, closed after writing]
+        self.files = {}
+        self.reported = set()
+        self.inotify_fd = None
+        self.watch_dirs = {}
+        # The watched folder paths, to look up without going through watch_dirs
+        self.watched_paths = set()
+        if platform.system() == "Linux":
+            self._init_inotify()
+        self.rescan()
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            self.libc = libc
+            self.inotify_fd = fd
+        except (OSError, AttributeError):
+            self.inotify_fd = None
+
+    def _add_watch(self, dir_path):
+        if self.inotify_fd is None:
+            return
+        wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(dir_path), INOTIFY_WATCH_MASK)
+        if wd >= 0:
+            self.watch_dirs[wd] = dir_path
+            self.watched_paths.add(dir_path)
+
+    def _update_file(self, file_path, now, closed=False):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self._forget_file(file_path)
+            return
+        entry = self.files.get(file_path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            self.files[file_path] = [stat.st_size, stat.st_mtime, now, closed]
+            # A file that was replaced or changed is reported again once it is stable
+            self.reported.discard(file_path)
+        elif closed:
+            entry[3] = True
+
+    def _forget_file(self, file_path):
+        self.files.pop(file_path, None)
+        self.reported.discard(file_path)
+
+    def _scan_dir(self, dir_path, now):
+        """Index every file below dir_path, adding inotify watches for each directory."""
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(dir_path):
             # Modify dirnames in-place to skip directories starting with a dot
             dirnames[:] = [d for d in dirnames if not d.startswith('.')]
-            files.extend(os.path.join(dirpath, f) for f in filenames if not f.startswith('.'))
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_file = {executor.submit(process_file, file): file for file in files if file not in stable_files}
+            if dirpath not in self.watched_paths:
+                self._add_watch(dirpath)
+            for f in filenames:
+                if f.startswith('.'):
+                    continue
+                file_path = os.path.join(dirpath, f)
+                seen.add(file_path)
+                self._update_file(file_path, now)
+        return seen
+
+    def rescan(self):
+        now = time.monotonic()
+        seen = self._scan_dir(self.path, now)
+        for file_path in list(self.files):
+            if file_path not in seen:
+                self._forget_file(file_path)
+
+    def _read_events(self, timeout):
+        """Apply pending inotify events to the index, waiting up to timeout seconds for the first one."""
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        now = time.monotonic()
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped, so the index can't be trusted anymore
+                    self.rescan()
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self.watched_paths.discard(self.watch_dirs.pop(wd, None))
+                    continue
+                dir_path = self.watch_dirs.get(wd)
+                if dir_path is None or not name or name.startswith('.'):
+                    continue
+                item_path = os.path.join(dir_path, name)
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._scan_dir(item_path, now)
+                    elif mask & IN_MOVED_FROM:
+                        prefix = item_path + os.sep
+                        for file_path in [f for f in self.files if f.startswith(prefix)]:
+                            self._forget_file(file_path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget_file(item_path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    # A finished write or an atomic rename means the file is complete
+                    self._update_file(item_path, now, closed=True)
+                else:
+                    self._update_file(item_path, now)
+
+    def poll(self, timeout=None):
+        """
+        Update the index and return the files that became stable since the last call.
+        Blocks for up to timeout seconds (default: settle_time) waiting for changes.
+        """
+        if timeout is None:
+            timeout = self.settle_time
+        if self.inotify_fd is not None:
+            self._read_events(timeout)
+            # Files that were already present when we started never send a close-write
+            # event, so they still need the size/mtime check below
+            now = time.monotonic()
+            for file_path, entry in list(self.files.items()):
+                if not entry[3] and file_path not in self.reported and now - entry[2] >= self.settle_time:
+                    self._update_file(file_path, now)
+        else:
+            time.sleep(timeout)
+            self.rescan()
 
-            for future in as_completed(future_to_file):
-                result = future.result()
-                if result:
-                    stable_files.add(result)
+        now = time.monotonic()
+        stable_files = []
+        for file_path, (size, mtime, last_change, closed) in self.files.items():
+            if file_path in self.reported:
+                continue
+            if closed or now - last_change >= self.settle_time:
+                stable_files.append(file_path)
+        self.reported.update(stable_files)
+        return stable_files
 
-        if len(stable_files) >= len(files):
-            break  # Exit if all files are stable
+    def has_unstable_files(self):
+        return any(file_path not in self.reported for file_path in self.files)
 
-    return len(stable_files)
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
 
 
 def calculate_output_dimensions(cropped_width, cropped_height, desired_ar):
@@ -172,62 +1011,2409 @@ def natural_sort_key(s):
             for text in re.split(r'(\d+)', s)]
 
 
-def delete_empty_media_dirs(media_dir, input_dir, media_extensions):
-    media_dir = os.path.abspath(media_dir)
-    input_dir = os.path.abspath(input_dir)
-    while media_dir != input_dir:
-        # Check if media_dir has any media files
-        has_media_files = False
-        for item in os.listdir(media_dir):
-            item_path = os.path.join(media_dir, item)
-            if os.path.isfile(item_path) and os.path.splitext(item)[1].lower() in media_extensions:
-                has_media_files = True
+class MediaDirCleanup:
+    """
+    Removes input folders once all media files below them are done. The number of media
+    files left below each folder is counted from the input watcher's index, so finishing a
+    file only updates a few counters instead of listing every folder up to input_dir.
+    Folders whose count drops to zero are removed together by flush(), along with any
+    non-media files left in them. As the counts can lag behind the folder by up to one
+    watcher poll, each folder is checked once more right before it is removed.
+    """
+
+    def __init__(self, input_dir, settle_time=2.5):
+        self.input_dir = os.path.abspath(input_dir)
+        self.settle_time = settle_time
+        self.counts = Counter()
+        self.known = set()
+        self.empty = set()
+        self.lock = threading.Lock()
+
+    def _parent_dirs(self, media_file):
+        media_dir = os.path.dirname(os.path.abspath(media_file))
+        while media_dir != self.input_dir and media_dir.startswith(self.input_dir + os.sep):
+            yield media_dir
+            media_dir = os.path.dirname(media_dir)
+
+    def sync(self, files, media_extensions):
+        """
+        Count the media files in files (e.g. the watcher index) that haven't been seen yet.
+        Counted files that are no longer in files (finished by another worker, or removed)
+        are treated as done.
+        """
+        with self.lock:
+            for media_file in files:
+                if media_file in self.known or not is_media_file(media_file, media_extensions):
+                    continue
+                self.known.add(media_file)
+                for media_dir in self._parent_dirs(media_file):
+                    self.counts[media_dir] += 1
+                    self.empty.discard(media_dir)
+            for media_file in [f for f in self.known if f not in files]:
+                self._forget(media_file)
+
+    def _forget(self, media_file):
+        self.known.discard(media_file)
+        for media_dir in self._parent_dirs(media_file):
+            self.counts[media_dir] -= 1
+            if self.counts[media_dir] <= 0:
+                del self.counts[media_dir]
+                self.empty.add(media_dir)
+
+    def done(self, media_file):
+        """A counted media file was finished and removed."""
+        with self.lock:
+            if media_file in self.known:
+                self._forget(media_file)
+
+    def _in_use(self, dir_path, media_extensions):
+        """
+        Whether dir_path holds a media file, or any file modified within settle_time
+        (e.g. one being copied in, or the hidden partial file of rsync).
+        """
+        now = time.time()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self._in_use(entry.path, media_extensions):
+                            return True
+                    elif (is_media_file(entry.path, media_extensions)
+                          or now - entry.stat(follow_symlinks=False).st_mtime < self.settle_time):
+                        return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            return True
+        return False
+
+    def flush(self, media_extensions):
+        """Remove the folders that have no media files left, the topmost of each branch only."""
+        with self.lock:
+            empty, self.empty = self.empty, set()
+        removed = set()
+        in_use = set()
+        for media_dir in sorted(empty):
+            if os.path.dirname(media_dir) in removed:
+                continue  # Removed with its parent
+            with cleanup_lock:
+                if self._in_use(media_dir, media_extensions):
+                    # Tried again on the next flush, unless sync() counts a new media file in it
+                    in_use.add(media_dir)
+                    continue
+                shutil.rmtree(media_dir, ignore_errors=True)
+            removed.add(media_dir)
+        with self.lock:
+            self.empty.update(d for d in in_use if not self.counts[d])
+
+
+class EncodeQueue:
+    """
+    The files waiting for a free job slot, in the order of a scheduling policy:
+    'natural' (by path), 'shortest' (shortest duration first, so a long film doesn't hold up
+    every episode behind it), 'priority' (by folder priority) or 'fair' (taking turns between
+    the top-level folders of the input folder).
+    The queue control file in the input folder is read again whenever it changes, so files
+    can be pinned and folder priorities changed while the queue runs:
+
+        # Started before anything else, in this order (files or folders)
+        pin = ["Movies/Big Film (2024).mkv", "TV/New Show"]
+
+        # For the 'priority' order: higher first, default 0. The most specific path counts.
+        [priority]
+        "TV/Kids" = 10
+        "Movies" = -5
+    """
+
+    def __init__(self, input_dir, policy):
+        self.input_dir = input_dir
+        self.policy = policy
+        self.files = []
+        self.durations = {}
+        # Turn counter and the last turn of each top-level folder, for 'fair'
+        self.turn = 0
+        self.last_turns = {}
+        self.control_path = os.path.join(input_dir, queue_control_file)
+        self.control_mtime = None
+        self.pins = []
+        self.priorities = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def _rel_path(self, media_file):
+        return os.path.relpath(media_file, self.input_dir).replace(os.sep, '/')
+
+    @staticmethod
+    def _is_below(rel_path, path):
+        return rel_path == path or rel_path.startswith(path + '/')
+
+    def _load_control_file(self):
+        try:
+            mtime = os.stat(self.control_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.control_mtime:
+            return
+        self.control_mtime = mtime
+        self.pins = []
+        self.priorities = {}
+        if mtime is None:
+            return
+        if tomllib is None:
+            print("Queue control files require Python 3.11 or newer (tomllib).")
+            return
+        try:
+            with open(self.control_path, 'rb') as f:
+                control = tomllib.load(f)
+            self.pins = [str(path).replace('\\', '/').strip('/') for path in control.get('pin', [])]
+            self.priorities = {str(path).replace('\\', '/').strip('/'): int(priority)
+                               for path, priority in control.get('priority', {}).items()}
+        except (OSError, tomllib.TOMLDecodeError, AttributeError, TypeError, ValueError) as e:
+            print(f"Unable to read queue control file '{self.control_path}': {e}")
+            return
+        print(f"Queue control file loaded: {len(self.pins)} pinned, {len(self.priorities)} folder priorities.")
+
+    def _priority(self, rel_path):
+        paths = [path for path in self.priorities if self._is_below(rel_path, path)]
+        return self.priorities[max(paths, key=len)] if paths else 0
+
+    @staticmethod
+    def _top_folder(rel_path):
+        return rel_path.split('/')[0] if '/' in rel_path else ''
+
+    def _sort_key(self, media_file):
+        rel_path = self._rel_path(media_file)
+        pin = next((i for i, path in enumerate(self.pins) if self._is_below(rel_path, path)), len(self.pins))
+        if self.policy == 'shortest':
+            duration = self.durations.get(media_file)
+            order = (duration is None, duration or 0)
+        elif self.policy == 'priority':
+            order = (-self._priority(rel_path),)
+        elif self.policy == 'fair':
+            order = (self.last_turns.get(self._top_folder(rel_path), -1),)
+        else:
+            order = ()
+        return (pin, *order, natural_sort_key(rel_path))
+
+    def add(self, media_files):
+        for media_file in media_files:
+            if media_file in self.files:
+                continue
+            self.files.append(media_file)
+            if self.policy == 'shortest' and media_file not in self.durations:
+                # From the probe cache, which the encode itself uses later on anyway
+                self.durations[media_file] = get_media_duration(media_file)
+
+    def peek(self):
+        """The file to start next, or None if the queue is empty."""
+        if not self.files:
+            return None
+        self._load_control_file()
+        return min(self.files, key=self._sort_key)
+
+    def remove(self, media_file):
+        self.files.remove(media_file)
+        self.durations.pop(media_file, None)
+
+    def started(self, media_file):
+        """Record that media_file was started, so 'fair' moves on to the next folder."""
+        self.turn += 1
+        self.last_turns[self._top_folder(self._rel_path(media_file))] = self.turn
+
+
+def get_encoder_options(codec):
+    """Encoder-specific FFmpeg options, including the psy-rd fine-tuning for x264/x265."""
+    encoder_options = {
+        'libx264': {
+            # -bf 4: Use up to 4 consecutive B-frames, increasing compression efficiency
+            # -rc-lookahead 32: Pre-scan 32 upcoming frames
+            # -aq-mode 3: Employ advanced adaptive quantization
+            # -b-pyramid normal: Allow B-frames to serve as references
+            # -coder 1: Enable CABAC entropy coding
+            'options': ['-bf', '4', '-rc-lookahead', '32', '-aq-mode', '3', '-b-pyramid', 'normal', '-coder', '1'],
+            'pix_fmt': None,
+        },
+        'libx265': {
+            # rc-lookahead=32, aq-mode=3, bframes=4
+            'options': ['-x265-params', 'rc-lookahead=32:aq-mode=3:bframes=4:no-sao=1'],
+            'pix_fmt': None,
+        },
+        'libvpx-vp9': {
+            'options': [],
+            'pix_fmt': None,
+        },
+        'libaom-av1': {
+            'options': [],
+            'pix_fmt': None,
+        },
+    }
+
+    # Fine-tune psy-rd if using x264 or x265
+    if codec == 'libx264':
+        encoder_options[codec]['options'].extend(['-psy-rd', '3.0:0.0'])
+    elif codec == 'libx265':
+        for i, opt in enumerate(encoder_options[codec]['options']):
+            if opt == '-x265-params':
+                encoder_options[codec]['options'][i + 1] += ':psy-rd=3:psy-rdoq=3'
+                break
+
+    return encoder_options[codec]
+
+
+def get_encoder_tuning_path():
+    return os.path.join(os.path.dirname(get_probe_cache_path()), encoder_tuning_file)
+
+
+def load_encoder_tuning_file():
+    try:
+        with open(get_encoder_tuning_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+encoder_tuning = None
+
+
+def load_encoder_tuning(codec):
+    """
+    The tuning measured by --benchmark for codec on this machine, or None. Results from a
+    machine with a different number of cores (e.g. a copied cache folder) are ignored.
+    """
+    global encoder_tuning
+    if encoder_tuning is None:
+        encoder_tuning = load_encoder_tuning_file()
+    if encoder_tuning.get('cores') != os.cpu_count():
+        return None
+    return encoder_tuning.get('codecs', {}).get(codec)
+
+
+def calculate_encoder_threads(codec, cpu_usage_percentage, concurrent_jobs=1):
+    """
+    Split the thread budget from the CPU usage prompt across the running jobs.
+    Returns 0 (FFmpeg decides) for a single job with 'auto' CPU usage, unless the
+    encoder has been benchmarked on this machine.
+    """
+    tuning = load_encoder_tuning(codec)
+    if cpu_usage_percentage == "auto":
+        if concurrent_jobs <= 1 and not tuning:
+            return 0
+        # FFmpeg's own thread detection assumes it has the whole machine,
+        # so split all cores between the jobs instead
+        cpu_usage_percentage = 100
+
+    num_cores = os.cpu_count() or 1
+
+    if tuning:
+        divisor = tuning['divisor']
+    elif codec == "libx265":
+        divisor = 4.5
+    else:
+        divisor = 0.8
+    thread_budget = num_cores * (cpu_usage_percentage / 100) // divisor
+    number_of_threads = max(1, int(thread_budget // concurrent_jobs))
+    if tuning:
+        # More threads than this gave no measurable speed-up in the benchmark
+        number_of_threads = min(tuning['max_threads'], number_of_threads)
+    elif codec == "libx264":
+        # Limit to 16 threads for x264, as recommended in some docs
+        number_of_threads = min(16, number_of_threads)
+    return number_of_threads
+
+
+def recommended_concurrent_jobs(codec):
+    """Number of simultaneous encodes needed to keep all cores busy with the given codec."""
+    tuning = load_encoder_tuning(codec)
+    if tuning:
+        return tuning['concurrent_jobs']
+    num_cores = os.cpu_count() or 1
+    return max(1, num_cores // codec_thread_limits.get(codec, num_cores))
+
+
+def is_media_file(file_path, media_extensions):
+    return os.path.splitext(file_path)[1].lower() in media_extensions
+
+
+def build_output_basename(media_file, codec_display_name):
+    basename = os.path.splitext(os.path.basename(media_file))[0]
+    # Replace codec names with codec_display_name and remove the other tags in one pass
+    return output_naming.apply(basename, codec_display_name)
+
+
+def build_ffmpeg_command(media_file, output_file, filter_str, settings, number_of_threads, direct_mux=False):
+    """
+    Build the video encode command. With direct_mux, audio, subtitles, attachments and
+    chapters are copied from the source as well, so the output is the final MKV.
+    """
+    codec = settings['codec']
+    encoder_speed = settings['encoder_speed']
+    encoder_options = get_encoder_options(codec)
+
+    cmd_ffmpeg = [ffmpeg, '-y', '-i', media_file]
+
+    if filter_str:
+        cmd_ffmpeg.extend(['-vf', filter_str])
+
+    if direct_mux:
+        cmd_ffmpeg.extend([
+            '-map', '0:v:0', '-map', '0:a?', '-map', '0:s?', '-map', '0:t?',
+            '-c', 'copy',
+            # Audio packets queue up while the encoder fills its lookahead
+            '-max_muxing_queue_size', '4096',
+        ])
+    else:
+        cmd_ffmpeg.extend(['-map', 'v:0'])  # Map only video
+
+    cmd_ffmpeg.extend([
+        '-c:v', codec,
+        '-crf', settings['quality'],
+        '-threads', str(number_of_threads),  # Limit CPU usage
+    ])
+
+    # Apply the encoder speed/preset depending on the codec
+    if codec in ['libx264', 'libx265']:
+        # Use '-preset'
+        cmd_ffmpeg.extend(['-preset', encoder_speed])
+    elif codec == 'libvpx-vp9':
+        # For VP9, use '-cpu-used'
+        cmd_ffmpeg.extend(['-cpu-used', encoder_speed])
+    elif codec == 'libaom-av1':
+        # For AV1, also use '-cpu-used'
+        cmd_ffmpeg.extend(['-cpu-used', encoder_speed])
+
+    # Add pix_fmt if specified for the codec
+    if encoder_options['pix_fmt']:
+        cmd_ffmpeg.extend(['-pix_fmt', encoder_options['pix_fmt']])
+
+    # Add encoder-specific options
+    cmd_ffmpeg.extend(encoder_options['options'])
+
+    # Add tune option if provided
+    if settings['tune_option']:
+        cmd_ffmpeg.extend(['-tune', settings['tune_option']])
+
+    # Add user-custom parameters if provided
+    if settings['user_custom_ffmpeg'].strip():
+        # A simple split() handles space-delimited arguments
+        cmd_ffmpeg.extend(settings['user_custom_ffmpeg'].split())
+
+    # Finally, the output
+    cmd_ffmpeg.append(output_file)
+    return cmd_ffmpeg
+
+
+def parse_progress_number(value):
+    """
+    Parse a numeric '-progress' value such as '23.9', '1.02x', '2310.5kbits/s' or 'N/A'.
+    Returns None if not a number.
+    """
+    try:
+        return float(str(value).removesuffix('kbits/s').rstrip('x'))
+    except ValueError:
+        return None
+
+
+def run_ffmpeg_process(cmd_ffmpeg, job=None, on_progress=None, capture_stderr=False, job_stats=True):
+    """
+    Run FFmpeg with '-progress pipe:1' and pass every progress report (frame, fps, speed,
+    out_time_us, total_size, ...) to on_progress and to the job's statistics. FFmpeg is
+    stopped once the job is (see EncodeJob.stopping). With job_stats=False the job is only
+    used for that, e.g. for audio tracks, which would skew the size and speed of the video.
+    Returns (return_code, stderr), stderr is only collected with capture_stderr=True.
+    """
+    cmd = cmd_ffmpeg[:1] + ['-progress', 'pipe:1'] + cmd_ffmpeg[1:]
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE if capture_stderr else None,
+                               text=True, errors='replace')
+    if job and job_stats:
+        job.process_started(process.pid)
+
+    # Read stderr on its own thread, so neither pipe can fill up and block FFmpeg
+    stderr_output = []
+    stderr_thread = None
+    if capture_stderr:
+        stderr_thread = threading.Thread(target=lambda: stderr_output.append(process.stderr.read()), daemon=True)
+        stderr_thread.start()
+
+    progress = {}
+    last_progress = {}
+    terminated = False
+    for line in process.stdout:
+        key, separator, value = line.strip().partition('=')
+        if not separator:
+            continue
+        progress[key] = value
+        if key == 'progress':
+            # 'progress=continue' (or 'end') closes each report
+            last_progress, progress = progress, {}
+            if job:
+                if job_stats:
+                    job.update_progress(process.pid, last_progress)
+                if job.stopping and not terminated:
+                    # Keep reading until FFmpeg has exited and closed the pipe. Popen.terminate()
+                    # polls first, which would reap the process before wait4 below gets its CPU time.
+                    if hasattr(os, 'wait4'):
+                        os.kill(process.pid, signal.SIGTERM)
+                    else:
+                        process.terminate()
+                    terminated = True
+            if on_progress:
+                on_progress(last_progress)
+    process.stdout.close()
+
+    cpu_time = None
+    if hasattr(os, 'wait4') and process.returncode is None:
+        # Unlike getrusage(), wait4 reports the CPU time of this FFmpeg process alone,
+        # even while other encodes are running
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            cpu_time = usage.ru_utime + usage.ru_stime
+        except ChildProcessError:
+            # Already reaped elsewhere
+            process.wait()
+    else:
+        process.wait()
+    if stderr_thread:
+        stderr_thread.join()
+        process.stderr.close()
+    if job and job_stats:
+        job.process_finished(process.pid, last_progress, cpu_time)
+    return process.returncode, ''.join(stderr_output)
+
+
+class EncodeJob:
+    """
+    Live progress and accumulated FFmpeg statistics of one file. Chunked encodes run several
+    FFmpeg processes per file at once, so the progress is tracked per process.
+    With watch_size(), the output size of all processes together is checked against a byte
+    rate limit; once it is clearly exceeded, skipped is set and the processes are stopped.
+    If one part of the job fails (e.g. an audio track), failed is set and the others stop too.
+    """
+
+    def __init__(self, media_file, settings, number_of_threads, duration=None):
+        self.media_file = media_file
+        self.settings = settings
+        self.number_of_threads = number_of_threads
+        self.output_file = None
+        self.duration = duration if duration is not None else get_media_duration(media_file)
+        self.started = time.monotonic()
+        self.encode_start = None
+        self.encode_end = None
+        self.frames = 0
+        self.cpu_time = 0.0
+        self.cpu_time_known = True
+        self.processes = {}
+        self.predicted_size = None
+        self.skipped = None
+        self.failed = None
+        # Set along with skipped when another worker took the file over
+        self.lease_lost = False
+        self.size_limit = None
+        self.finished_bytes = 0
+        self.finished_seconds = 0.0
+        self.phase = 'starting'
+        self.encoded_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def watch_size(self, bytes_per_second):
+        """Stop the following FFmpeg runs if their output grows faster than bytes_per_second."""
+        with self.lock:
+            self.size_limit = bytes_per_second
+            self.finished_bytes = 0
+            self.finished_seconds = 0.0
+
+    def _check_size(self):
+        if not self.size_limit or self.skipped or not self.duration:
+            return
+        running = [p for p in self.processes.values() if p]
+        encoded_bytes = self.finished_bytes + sum(parse_progress_number(p.get('total_size')) or 0 for p in running)
+        encoded_seconds = self.finished_seconds + sum((parse_progress_number(p.get('out_time_us')) or 0) / 1000000
+                                                      for p in running)
+        if encoded_seconds < max(size_abort_min_seconds, size_abort_fraction * self.duration):
+            return
+        if encoded_bytes / encoded_seconds > self.size_limit:
+            projected = encoded_bytes / encoded_seconds * self.duration
+            self.skipped = f"on course for {projected / 1024 ** 3:.2f} GiB, larger than the source"
+
+    @property
+    def stopping(self):
+        """Whether the job's FFmpeg processes should stop, as it was skipped or a part of it failed."""
+        return bool(self.skipped or self.failed)
+
+    def set_phase(self, phase):
+        """Label the current step for the dashboard. Entering 'encoding' restarts the progress count."""
+        with self.lock:
+            self.phase = phase
+            if phase == 'encoding':
+                self.encoded_seconds = 0.0
+
+    def process_started(self, pid):
+        with self.lock:
+            if self.encode_start is None:
+                self.encode_start = time.monotonic()
+            self.processes[pid] = {}
+
+    def update_progress(self, pid, progress):
+        with self.lock:
+            self.processes[pid] = progress
+            self._check_size()
+
+    def process_finished(self, pid, progress, cpu_time):
+        with self.lock:
+            self.processes.pop(pid, None)
+            self.encode_end = time.monotonic()
+            self.finished_bytes += parse_progress_number(progress.get('total_size')) or 0
+            out_seconds = (parse_progress_number(progress.get('out_time_us')) or 0) / 1000000
+            self.finished_seconds += out_seconds
+            self.encoded_seconds += out_seconds
+            self.frames += int(parse_progress_number(progress.get('frame')) or 0)
+            if cpu_time is None:
+                self.cpu_time_known = False
+            else:
+                self.cpu_time += cpu_time
+
+    def live_stats(self):
+        """Current fps and speed summed over the running FFmpeg processes of this job."""
+        with self.lock:
+            running = list(self.processes.values())
+        fps = sum(parse_progress_number(p.get('fps')) or 0 for p in running)
+        speed = sum(parse_progress_number(p.get('speed')) or 0 for p in running)
+        return fps, speed
+
+    def snapshot(self):
+        """
+        Live progress of this job: phase, seconds encoded, fps, speed, bitrate (kbit/s) and
+        the estimated seconds left. Values FFmpeg hasn't reported yet are None.
+        """
+        with self.lock:
+            phase = self.phase
+            running = list(self.processes.values())
+            encoded = self.encoded_seconds + sum((parse_progress_number(p.get('out_time_us')) or 0) / 1000000
+                                                 for p in running)
+        fps = sum(parse_progress_number(p.get('fps')) or 0 for p in running)
+        speed = sum(parse_progress_number(p.get('speed')) or 0 for p in running)
+        # Chunks each report their own average, so show the mean of the running processes
+        bitrates = [b for b in (parse_progress_number(p.get('bitrate')) for p in running) if b]
+        bitrate = sum(bitrates) / len(bitrates) if bitrates else None
+        remaining = max(self.duration - encoded, 0) if self.duration else None
+        return {
+            'phase': phase,
+            'encoded': encoded,
+            'fps': fps if running else None,
+            'speed': speed if running else None,
+            'bitrate': bitrate,
+            'remaining': remaining,
+            'eta': remaining / speed if remaining is not None and speed else None,
+        }
+
+    def record(self, status):
+        """The metrics log entry of the finished job."""
+        wall_time = time.monotonic() - self.started
+        encode_time = None
+        if self.encode_start is not None and self.encode_end is not None:
+            encode_time = self.encode_end - self.encode_start
+        output_size = None
+        if status == 'done' and self.output_file and os.path.exists(self.output_file):
+            output_size = os.path.getsize(self.output_file)
+
+        def rounded(value, digits=2):
+            return round(value, digits) if value is not None else None
+
+        return {
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'file': self.media_file,
+            'status': status,
+            'codec': self.settings['codec'],
+            'preset': self.settings['encoder_speed'],
+            'crf': self.settings['quality'],
+            'tune': self.settings['tune_option'],
+            'threads': self.number_of_threads,
+            'segmented': self.settings['segmented'],
+            'duration': rounded(self.duration),
+            'wall_time': rounded(wall_time),
+            'encode_time': rounded(encode_time),
+            'cpu_time': rounded(self.cpu_time) if self.cpu_time_known and encode_time is not None else None,
+            'frames': self.frames,
+            'fps': rounded(self.frames / encode_time) if encode_time else None,
+            # Seconds of video encoded per second, like FFmpeg's own 'speed'
+            'speed': rounded(self.duration / encode_time, 3) if self.duration and encode_time else None,
+            'predicted_size': int(self.predicted_size) if self.predicted_size else None,
+            'output_size': output_size,
+            'output_bitrate_kbps': rounded(output_size * 8 / self.duration / 1000, 1)
+            if output_size and self.duration else None,
+        }
+
+
+class EncodeMetrics:
+    """
+    Collects the throughput of every encode and appends one record per finished file to the
+    metrics log (JSON lines, or CSV for a '.csv' path). With serve(), running totals and the
+    live fps/speed of the running jobs are also available in the Prometheus text format.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.files = Counter()
+        self.totals = Counter()
+        self.last_record = None
+        self.queued_files = 0
+
+    def start_job(self, media_file, settings, number_of_threads):
+        job = EncodeJob(media_file, settings, number_of_threads)
+        with self.lock:
+            self.jobs.append(job)
+        return job
+
+    def finish_job(self, job, success):
+        record = job.record('done' if success else 'skipped' if job.skipped else 'failed')
+        with self.lock:
+            self.jobs.remove(job)
+            self.files[record['status']] += 1
+            for key in ['encode_time', 'cpu_time', 'frames', 'duration', 'output_size']:
+                self.totals[key] += record[key] or 0
+            self.last_record = record
+            self._write(record)
+
+    def _write(self, record):
+        try:
+            if self.log_path.lower().endswith('.csv'):
+                write_header = not os.path.exists(self.log_path) or os.path.getsize(self.log_path) == 0
+                with open(self.log_path, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=metrics_fields)
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerow(record)
+            else:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            print(f"Unable to write metrics to '{self.log_path}': {e}")
+
+    def render_prometheus(self):
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP media_encoder_{name} {help_text}")
+            lines.append(f"# TYPE media_encoder_{name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"media_encoder_{name}{labels} {value}")
+
+        with self.lock:
+            jobs = list(self.jobs)
+            metric('files_total', 'counter', "Files processed, by result.",
+                   [(f'{{status="{status}"}}', self.files[status]) for status in ['done', 'skipped', 'failed']])
+            metric('encode_seconds_total', 'counter', "Wall time spent encoding.",
+                   [('', round(self.totals['encode_time'], 2))])
+            metric('cpu_seconds_total', 'counter', "CPU time used by the encoder processes.",
+                   [('', round(self.totals['cpu_time'], 2))])
+            metric('frames_total', 'counter', "Frames encoded.", [('', self.totals['frames'])])
+            metric('media_seconds_total', 'counter', "Duration of the encoded media.",
+                   [('', round(self.totals['duration'], 2))])
+            metric('output_bytes_total', 'counter', "Size of the finished output files.",
+                   [('', self.totals['output_size'])])
+            metric('queued_files', 'gauge', "Files waiting for a free job slot.", [('', self.queued_files)])
+            metric('running_jobs', 'gauge', "Files being encoded.", [('', len(jobs))])
+            if self.last_record:
+                metric('last_fps', 'gauge', "Average fps of the last finished file.",
+                       [('', self.last_record['fps'] or 0)])
+                metric('last_speed', 'gauge', "Average speed of the last finished file.",
+                       [('', self.last_record['speed'] or 0)])
+                metric('last_output_bitrate_kbps', 'gauge', "Output bitrate of the last finished file.",
+                       [('', self.last_record['output_bitrate_kbps'] or 0)])
+
+        job_stats = [(f'{{file="{label(os.path.basename(job.media_file))}"}}', job.live_stats()) for job in jobs]
+        metric('job_fps', 'gauge', "Current fps of each running file.",
+               [(labels, round(fps, 2)) for labels, (fps, _) in job_stats])
+        metric('job_speed', 'gauge', "Current speed of each running file.",
+               [(labels, round(speed, 3)) for labels, (_, speed) in job_stats])
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """Serve the metrics on http://<host>:<port>/metrics from a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def format_duration(seconds):
+    """Format seconds as H:MM:SS, or '-' if unknown."""
+    if seconds is None:
+        return '-'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class EncodeDashboard:
+    """
+    Live table of the running encodes for the 'dashboard' UI: phase, progress, fps, speed,
+    bitrate and ETA of every file, plus the throughput and time left for the whole queue.
+    The FFmpeg readers only store their latest progress values; the table is rebuilt from
+    those on rich's own refresh timer, so a slow terminal never holds up an encode.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def render(self):
+        with self.metrics.lock:
+            jobs = list(self.metrics.jobs)
+            queued_files = self.metrics.queued_files
+            files = Counter(self.metrics.files)
+            finished_duration = self.metrics.totals['duration']
+
+        table = Table(expand=False)
+        table.add_column("File", overflow="ellipsis", max_width=50, no_wrap=True)
+        table.add_column("Status")
+        table.add_column("Progress", justify="right")
+        table.add_column("FPS", justify="right")
+        table.add_column("Speed", justify="right")
+        table.add_column("Bitrate", justify="right")
+        table.add_column("ETA", justify="right")
+
+        total_fps = 0
+        total_speed = 0
+        remaining = 0
+        for job in jobs:
+            stats = job.snapshot()
+            total_fps += stats['fps'] or 0
+            total_speed += stats['speed'] or 0
+            remaining += stats['remaining'] or 0
+            progress = f"{100 * stats['encoded'] / job.duration:.1f}%" if job.duration else '-'
+            table.add_row(
+                os.path.basename(job.media_file),
+                stats['phase'],
+                progress,
+                f"{stats['fps']:.1f}" if stats['fps'] is not None else '-',
+                f"{stats['speed']:.2f}x" if stats['speed'] is not None else '-',
+                f"{stats['bitrate']:.0f} kbit/s" if stats['bitrate'] else '-',
+                format_duration(stats['eta']),
+            )
+
+        # Files still in the queue haven't been probed yet, so assume the average length so far
+        known_durations = [job.duration for job in jobs if job.duration]
+        known_files = sum(files.values()) + len(known_durations)
+        if queued_files and known_files:
+            remaining += queued_files * (finished_duration + sum(known_durations)) / known_files
+        queue_eta = remaining / total_speed if total_speed else None
+
+        table.caption = (f"{len(jobs)} running, {queued_files} queued, {files['done']} done, "
+                         f"{files['skipped']} skipped, {files['failed']} failed | "
+                         f"{total_fps:.1f} fps, {total_speed:.2f}x | queue ETA {format_duration(queue_eta)}")
+        table.caption_justify = "left"
+        return table
+
+
+def run_ffmpeg(cmd_ffmpeg, media_file, settings, job=None):
+    """Run one FFmpeg encode with the selected UI. Returns True on success."""
+    if settings['ffmpeg_ui'] in ["quiet", "dashboard"]:
+        # Progress bars from several jobs would overwrite each other, so only report
+        # start/finish and collect errors (the dashboard reads the progress from the job)
+        cmd_quiet = cmd_ffmpeg[:1] + ['-nostats', '-loglevel', 'error'] + cmd_ffmpeg[1:]
+        console.print(f"Encoding {os.path.basename(media_file)}", highlight=False)
+        return_code, stderr = run_ffmpeg_process(cmd_quiet, job, capture_stderr=True)
+        if return_code != 0:
+            if not (job and job.stopping):
+                print(f"Error encoding video '{media_file}':\n{stderr}")
+            return False
+        return True
+
+    console.print(f"\n{' '.join(cmd_ffmpeg)}\n", style="bold bright_black", highlight=False)
+    if settings['ffmpeg_ui'].lower() == "compact":
+        duration = job.duration if job else get_media_duration(media_file)
+        cmd_compact = cmd_ffmpeg[:1] + ['-nostats'] + cmd_ffmpeg[1:]
+        with Progress(SpinnerColumn(), TextColumn("Processing {task.description}"), BarColumn(),
+                      TaskProgressColumn(), TimeElapsedColumn(), TimeRemainingColumn(),
+                      console=console) as progress_bar:
+            task = progress_bar.add_task(os.path.basename(media_file), total=duration)
+
+            def show_progress(progress):
+                out_time_us = parse_progress_number(progress.get('out_time_us'))
+                if out_time_us is not None:
+                    progress_bar.update(task, completed=out_time_us / 1000000)
+
+            return_code, _ = run_ffmpeg_process(cmd_compact, job, show_progress, capture_stderr=True)
+        if return_code != 0 and job and job.stopping:
+            return False
+        if return_code != 0:
+            print(f"Error: FFmpeg returned a non-zero exit code ({return_code}). Skipping file.")
+            return False
+    else:
+        return_code, _ = run_ffmpeg_process(cmd_ffmpeg, job)
+        if return_code != 0 and job and job.stopping:
+            return False
+        if return_code != 0:
+            print(f"Error encoding video '{media_file}': FFmpeg returned exit code {return_code}")
+            return False
+    return True
+
+
+class EncodeJournal:
+    """
+    Persistent record of the state of each file being worked on (queued, encoding, muxing,
+    done), stored as JSON in the output folder. After a crash or kill, the next run uses it
+    to clean up orphaned temporary files, skip work that already finished, and resume
+    chunked encodes from the last completed chunk. Entries are removed once a file is done
+    and its source deleted, so the journal only ever holds the files in flight.
+    It also reserves the output name of each file, see claim_output(). With reserve_output,
+    names are also reserved with the other workers sharing the queue, see EncodeLeases.
+    """
+
+    def __init__(self, path, reserve_output=None):
+        self.path = path
+        self.reserve_output = reserve_output
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _source_matches(media_file, entry):
+        try:
+            stat = os.stat(media_file)
+        except OSError:
+            return False
+        return entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns
+
+    def get(self, media_file):
+        """The entry for media_file, or None if there is none for this exact version of the file."""
+        key = os.path.abspath(media_file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not self._source_matches(key, entry):
+                return None
+            return dict(entry)
+
+    def _current_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None or not self._source_matches(key, entry):
+            stat = os.stat(key)
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'temp_files': []}
+            self.entries[key] = entry
+        return entry
+
+    def update(self, media_file, state=None, **fields):
+        key = os.path.abspath(media_file)
+        with self.lock:
+            entry = self._current_entry(key)
+            if state:
+                entry['state'] = state
+            entry.update(fields)
+            self._save()
+
+    def claim_output(self, media_file, output_file):
+        """
+        Reserve output_file for media_file and return the path to write to. If the name is
+        already reserved by another file in progress (here or on another worker), or a file by
+        that name already exists (and isn't this file's own output from an interrupted run),
+        ' (2)', ' (3)', ... is added.
+        """
+        key = os.path.abspath(media_file)
+        with self.lock:
+            entry = self._current_entry(key)
+            if entry.get('output_file') and (not self.reserve_output
+                                             or self.reserve_output(media_file, entry['output_file'])):
+                return entry['output_file']
+            claimed = {e.get('output_file') for k, e in self.entries.items() if k != key}
+            base, extension = os.path.splitext(os.path.abspath(output_file))
+            candidate = base + extension
+            number = 1
+            while (candidate in claimed or os.path.exists(candidate)
+                   or (self.reserve_output and not self.reserve_output(media_file, candidate))):
+                number += 1
+                candidate = f"{base} ({number}){extension}"
+            entry['output_file'] = candidate
+            self._save()
+        if number > 1:
+            print(f"Output name '{os.path.basename(output_file)}' is already taken, "
+                  f"writing '{os.path.basename(candidate)}' instead.")
+        return candidate
+
+    def add_completed_chunk(self, media_file, chunk_name):
+        key = os.path.abspath(media_file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.setdefault('chunks_done', []).append(chunk_name)
+                self._save()
+
+    def remove(self, media_file):
+        with self.lock:
+            if self.entries.pop(os.path.abspath(media_file), None) is not None:
+                self._save()
+
+    def recover(self, in_use=None):
+        """
+        Clean up after an interrupted run. Returns the number of files that can be resumed.
+        in_use(media_file) is True for files another worker has taken over since; their
+        entries are dropped without touching the temporary files, which are now that worker's.
+        """
+        resumable = 0
+        with self.lock:
+            for media_file, entry in list(self.entries.items()):
+                source_ok = self._source_matches(media_file, entry)
+                state = entry.get('state')
+                if in_use and source_ok and in_use(media_file):
+                    orphans = []
+                    chunk_dir = None
+                    del self.entries[media_file]
+                elif not source_ok or state == 'queued':
+                    # The source is gone (or changed), or the work never started
+                    orphans = entry.get('temp_files', []) if not source_ok else []
+                    chunk_dir = entry.get('chunk_dir') if not source_ok else None
+                    del self.entries[media_file]
+                elif state == 'skipped':
+                    # Kept so the file isn't checked again while it stays unchanged
+                    orphans = []
+                    chunk_dir = None
+                elif state == 'encoding':
+                    # A partially written encode can't be continued, but finished chunks can
+                    orphans = entry.get('temp_files', [])
+                    chunk_dir = None
+                    entry['temp_files'] = []
+                    resumable += 1
+                else:
+                    # 'muxing' re-runs only the merge, 'done' only the clean up
+                    orphans = []
+                    chunk_dir = None
+                    resumable += 1
+                for temp_file in orphans:
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
+                if chunk_dir:
+                    shutil.rmtree(chunk_dir, ignore_errors=True)
+            self._save()
+        return resumable
+
+
+def process_is_running(pid):
+    """Whether a process with this pid exists on this machine. Not supported on Windows (always True)."""
+    if platform.system() == "Windows":
+        # os.kill() would terminate the process there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class EncodeLeases:
+    """
+    Claims on the files being encoded when several workers share one input folder. Every
+    claimed file has a lease folder in input/.leases: creating the folder is the claim, as
+    that either succeeds or fails atomically on local disks and network shares alike. The
+    owner file inside is renewed every lease_heartbeat_interval seconds by writing a new copy
+    and renaming it over the old one.
+    A lease whose owner file hasn't changed for lease_timeout seconds is taken over. The time
+    is measured with this worker's own clock, so the hosts' clocks don't need to agree, and
+    leases of dead processes on the same host are taken over right away. Taking over renames
+    the lease folder away first, which only one worker can do, and the old owner notices
+    at its next renewal and stops its encode.
+    The worker name is leased the same way, as every worker keeps its own journal, and the
+    output names in use are reserved in input/.leases/outputs, see reserve_output().
+    """
+
+    def __init__(self, input_dir, output_dir, worker_name):
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.path = os.path.join(self.input_dir, lease_dir)
+        self.outputs_path = os.path.join(self.path, 'outputs')
+        self.worker_name = worker_name
+        self.owner = f"{worker_name}-{os.getpid()}"
+        self.host = platform.node()
+        self.held = {}
+        self.seen = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.outputs_path, exist_ok=True)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew_leases, daemon=True)
+        self.thread.start()
+
+    def _lease_path(self, media_file):
+        # The share may be mounted at different paths on each host, so use the relative path
+        rel_path = os.path.relpath(os.path.abspath(media_file), self.input_dir).replace(os.sep, '/')
+        return os.path.join(self.path, hashlib.sha1(rel_path.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _read_owner(lease_path):
+        try:
+            with open(os.path.join(lease_path, 'owner.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, lease_path, data):
+        # Fails if the lease folder was taken over in the meantime
+        temp_path = os.path.join(lease_path, f'owner.{self.owner}.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, os.path.join(lease_path, 'owner.json'))
+
+    def _write_owner(self, lease_path, name, heartbeat):
+        self._write_json(lease_path, {
+            'owner': self.owner,
+            'host': self.host,
+            'pid': os.getpid(),
+            'file': name,
+            'heartbeat': heartbeat,
+            'renewed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+
+    def _is_abandoned(self, lease_path):
+        owner = self._read_owner(lease_path)
+        if owner and owner.get('host') == self.host and not process_is_running(owner.get('pid')):
+            return True
+        heartbeat = (owner.get('owner'), owner.get('heartbeat')) if owner else None
+        now = time.monotonic()
+        last_seen = self.seen.get(lease_path)
+        if last_seen is None or last_seen[0] != heartbeat:
+            self.seen[lease_path] = (heartbeat, now)
+            return False
+        return now - last_seen[1] > lease_timeout
+
+    def in_use(self, media_file):
+        """Whether another worker currently holds a lease on media_file (dead processes on this host excluded)."""
+        lease_path = self._lease_path(media_file)
+        if not os.path.isdir(lease_path):
+            return False
+        owner = self._read_owner(lease_path)
+        return not (owner and owner.get('host') == self.host and not process_is_running(owner.get('pid')))
+
+    def claim(self, media_file):
+        """Claim media_file for this worker. Returns False if another worker holds a live lease on it."""
+        return self._claim(media_file, self._lease_path(media_file),
+                           os.path.relpath(os.path.abspath(media_file), self.input_dir))
+
+    def claim_worker_name(self):
+        """
+        Lease the worker name, so two workers never share one journal. A worker on another
+        host only counts as gone once its lease times out, so this can wait up to lease_timeout.
+        Returns False if a live worker uses the name.
+        """
+        lease_path = os.path.join(self.path, f'worker-{self.worker_name}')
+        deadline = time.monotonic() + lease_timeout + lease_heartbeat_interval
+        while not self._claim(lease_path, lease_path, f'worker-{self.worker_name}'):
+            owner = self._read_owner(lease_path) or {}
+            if owner.get('host') == self.host or time.monotonic() > deadline:
+                return False
+            print(f"Worker name '{self.worker_name}' is in use on {owner.get('host', 'another host')}, "
+                  f"waiting to see if that worker is still running...")
+            time.sleep(lease_heartbeat_interval)
+        return True
+
+    def _claim(self, key, lease_path, name):
+        try:
+            os.mkdir(lease_path)
+        except FileExistsError:
+            if not self._is_abandoned(lease_path):
+                return False
+            owner = self._read_owner(lease_path) or {}
+            try:
+                os.rename(lease_path, f"{lease_path}.stale-{self.owner}-{time.time_ns()}")
+            except OSError:
+                return False  # Another worker took it over first
+            print(f"Taking over '{name}' from worker {owner.get('owner', 'unknown')}, "
+                  f"which stopped renewing its lease.")
+            self.seen.pop(lease_path, None)
+            for stale_path in [os.path.join(self.path, d) for d in os.listdir(self.path) if '.stale-' in d]:
+                shutil.rmtree(stale_path, ignore_errors=True)
+            try:
+                os.mkdir(lease_path)
+            except FileExistsError:
+                return False
+        try:
+            self._write_owner(lease_path, name, 0)
+        except OSError:
+            return False
+        with self.lock:
+            self.held[key] = {'path': lease_path, 'name': name, 'heartbeat': 0, 'job': None, 'outputs': set()}
+        return True
+
+    def reserve_output(self, media_file, output_file):
+        """
+        Reserve the output name output_file for media_file with all workers, so no two workers
+        ever write to the same output (or temporary output) file. Returns False if it is taken.
+        A reservation is kept until the lease on media_file is released, and dropped by the
+        next worker that wants the name once nobody holds a lease on its file anymore.
+        """
+        rel_output = os.path.relpath(os.path.abspath(output_file), self.output_dir).replace(os.sep, '/')
+        path = os.path.join(self.outputs_path, hashlib.sha1(rel_output.encode('utf-8')).hexdigest())
+        lease_name = os.path.basename(self._lease_path(media_file))
+        for _ in range(2):
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                holder = self._read_owner(path)
+                if holder is None:
+                    return False  # Just created, or unreadable
+                if holder.get('lease') != lease_name:
+                    if os.path.isdir(os.path.join(self.path, holder.get('lease', ''))):
+                        return False
+                    stale_path = f"{path}.stale-{self.owner}-{time.time_ns()}"
+                    try:
+                        os.rename(path, stale_path)
+                    except OSError:
+                        return False
+                    shutil.rmtree(stale_path, ignore_errors=True)
+                    continue
+            else:
+                try:
+                    self._write_json(path, {'lease': lease_name, 'output': rel_output})
+                except OSError:
+                    return False
+            with self.lock:
+                if media_file in self.held:
+                    self.held[media_file]['outputs'].add(path)
+            return True
+        return False
+
+    def attach(self, media_file, job):
+        """Stop job (an EncodeJob) if the lease on media_file is lost."""
+        with self.lock:
+            if media_file in self.held:
+                self.held[media_file]['job'] = job
+
+    def _renew_leases(self):
+        while not self.stopped.wait(lease_heartbeat_interval):
+            with self.lock:
+                held = list(self.held.items())
+            for key, lease in held:
+                owner = self._read_owner(lease['path'])
+                try:
+                    if not owner or owner.get('owner') != self.owner:
+                        raise OSError("claimed by another worker")
+                    lease['heartbeat'] += 1
+                    self._write_owner(lease['path'], lease['name'], lease['heartbeat'])
+                except OSError:
+                    # Its output names now belong to the worker that took over
+                    with self.lock:
+                        self.held.pop(key, None)
+                    job = lease['job']
+                    if job and not job.skipped:
+                        job.lease_lost = True
+                        job.skipped = "another worker took over its lease"
+                    print(f"Lost the lease on '{lease['name']}' to another worker.")
+
+    def release(self, media_file):
+        """Give up the lease on media_file. Returns False if it had already been lost to another worker."""
+        with self.lock:
+            lease = self.held.pop(media_file, None)
+        if lease is None:
+            return False
+        owner = self._read_owner(lease['path'])
+        if not owner or owner.get('owner') != self.owner:
+            return False
+        # Move the folder away first, so nobody sees a half-removed lease
+        released_path = f"{lease['path']}.stale-{self.owner}-{time.time_ns()}"
+        try:
+            os.rename(lease['path'], released_path)
+        except OSError:
+            return False
+        shutil.rmtree(released_path, ignore_errors=True)
+        for output_path in lease['outputs']:
+            shutil.rmtree(output_path, ignore_errors=True)
+        return True
+
+    def close(self):
+        self.stopped.set()
+        for media_file in list(self.held):
+            self.release(media_file)
+
+
+def split_video_into_chunks(media_file, chunk_dir, segment_length):
+    """
+    Losslessly split the first video stream into chunks of roughly segment_length seconds.
+    The segment muxer can only cut a stream copy on keyframes, so every chunk starts
+    on a keyframe (which encoders already place on scene cuts). With open-GOP sources
+    (common on Blu-ray) that keyframe may not be an IDR frame, and the frames before it
+    in display order are dropped when a chunk is decoded on its own, so the encoded
+    chunks have to be checked, see count_video_frames(). Returns the sorted chunk paths.
+    """
+    cmd_split = [ffmpeg, '-y', '-nostats', '-loglevel', 'error', '-i', media_file,
+                 '-map', '0:v:0', '-c', 'copy',
+                 '-f', 'segment', '-segment_time', str(segment_length), '-reset_timestamps', '1',
+                 os.path.join(chunk_dir, 'chunk_%05d.mkv')]
+    result = subprocess.run(cmd_split, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Error splitting '{media_file}' into chunks:\n{result.stderr}")
+        return []
+    return sorted(os.path.join(chunk_dir, f) for f in os.listdir(chunk_dir) if f.startswith('chunk_'))
+
+
+def count_video_frames(file):
+    """Number of packets (one per frame) in the first video stream, counted without decoding. None on failure."""
+    cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+           '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', file]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        return int(result.stdout.strip().rstrip(','))
+    except ValueError:
+        return None
+
+
+def concat_video_chunks(chunk_files, output_file, chunk_dir):
+    """Join encoded chunks back into one video stream without re-encoding."""
+    list_file = os.path.join(chunk_dir, 'concat.txt')
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for chunk_file in chunk_files:
+            escaped = os.path.abspath(chunk_file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    cmd_concat = [ffmpeg, '-y', '-nostats', '-loglevel', 'error',
+                  '-f', 'concat', '-safe', '0', '-i', list_file,
+                  '-map', '0:v:0', '-c', 'copy', output_file]
+    result = subprocess.run(cmd_concat, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Error joining chunks into '{output_file}':\n{result.stderr}")
+        return False
+    return True
+
+
+def encode_segmented(media_file, temp_video_file, filter_str, settings, number_of_threads, journal=None,
+                     job=None):
+    """
+    Encode one file as independent chunks in parallel and concatenate the result into
+    temp_video_file, so the rest of the pipeline sees a single encode as usual.
+    With a journal, chunks finished before an interruption are not encoded again.
+    If the joined video is missing frames, the file is encoded again in one piece.
+    """
+    name = os.path.basename(media_file)
+    chunk_dir = os.path.join(os.path.dirname(temp_video_file),
+                             '.' + os.path.splitext(os.path.basename(temp_video_file))[0] + '_chunks')
+
+    entry = journal.get(media_file) if journal else None
+    chunks_done = set()
+    if (entry and entry.get('chunks_split') and entry.get('chunk_dir') == chunk_dir
+            and entry.get('segment_length') == settings['segment_length'] and os.path.isdir(chunk_dir)):
+        chunk_files = sorted(os.path.join(chunk_dir, f) for f in os.listdir(chunk_dir) if f.startswith('chunk_'))
+        chunks_done = {c for c in entry.get('chunks_done', [])
+                       if os.path.exists(os.path.join(chunk_dir, 'encoded_' + c))}
+        console.print(f"Resuming {name} from chunk {len(chunks_done) + 1}/{len(chunk_files)}", highlight=False)
+    else:
+        if os.path.exists(chunk_dir):
+            shutil.rmtree(chunk_dir)
+        os.makedirs(chunk_dir)
+        if journal:
+            journal.update(media_file, chunk_dir=chunk_dir, segment_length=settings['segment_length'],
+                           chunks_split=False, chunks_done=[])
+        chunk_files = split_video_into_chunks(media_file, chunk_dir, settings['segment_length'])
+        if not chunk_files:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            return False
+        if journal:
+            journal.update(media_file, chunks_split=True)
+        console.print(f"Encoding {name} as {len(chunk_files)} chunks", highlight=False)
+
+    def encode_chunk(chunk_file):
+        encoded_file = os.path.join(chunk_dir, 'encoded_' + os.path.basename(chunk_file))
+        cmd_ffmpeg = build_ffmpeg_command(chunk_file, encoded_file, filter_str, settings, number_of_threads)
+        cmd_ffmpeg = cmd_ffmpeg[:1] + ['-nostats', '-loglevel', 'error'] + cmd_ffmpeg[1:]
+        return_code, stderr = run_ffmpeg_process(cmd_ffmpeg, job, capture_stderr=True)
+        if return_code != 0 and job and job.stopping:
+            raise RuntimeError(f"Stopped encoding {name}: {job.skipped or job.failed}")
+        if return_code != 0:
+            raise RuntimeError(f"Error encoding chunk '{chunk_file}':\n{stderr}")
+        if journal:
+            journal.add_completed_chunk(media_file, os.path.basename(chunk_file))
+        return encoded_file
+
+    encoded_files = {c: os.path.join(chunk_dir, 'encoded_' + os.path.basename(c))
+                     for c in chunk_files if os.path.basename(c) in chunks_done}
+    with ThreadPoolExecutor(max_workers=settings['segment_jobs']) as executor:
+        future_to_chunk = {executor.submit(encode_chunk, chunk): chunk
+                           for chunk in chunk_files if chunk not in encoded_files}
+        for future in as_completed(future_to_chunk):
+            try:
+                encoded_files[future_to_chunk[future]] = future.result()
+            except RuntimeError as e:
+                for pending in future_to_chunk:
+                    pending.cancel()
+                if job and job.skipped:
+                    # Nothing to resume, the file won't be encoded
+                    executor.shutdown(wait=True)
+                    shutil.rmtree(chunk_dir, ignore_errors=True)
+                else:
+                    print(e)
+                return False
+            console.print(f"[{len(encoded_files)}/{len(chunk_files)} chunks] {name}",
+                          style="bright_black", highlight=False)
+
+    if not concat_video_chunks([encoded_files[c] for c in chunk_files], temp_video_file, chunk_dir):
+        return False
+    # The chunks hold exactly the source's video packets, so any difference means frames
+    # were dropped at the chunk boundaries (open-GOP sources) and the video would end up
+    # shorter than the audio
+    source_frames = [count_video_frames(c) for c in chunk_files]
+    encoded_frames = count_video_frames(temp_video_file)
+    frames_match = None not in source_frames and sum(source_frames) == encoded_frames
+    # Chunks are kept until here so an interrupted encode can resume from them
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    if journal:
+        journal.update(media_file, chunk_dir=None, chunks_split=False, chunks_done=[])
+    if frames_match:
+        return True
+
+    console.print(f"Chunked encode of {name} has {encoded_frames} frames instead of "
+                  f"{sum(f or 0 for f in source_frames)}, encoding it in one piece instead",
+                  style="yellow", highlight=False)
+    os.remove(temp_video_file)
+    # This single encode gets the thread budget of all the chunk encodes
+    if number_of_threads:
+        number_of_threads *= settings['segment_jobs']
+    cmd_ffmpeg = build_ffmpeg_command(media_file, temp_video_file, filter_str, settings, number_of_threads)
+    return run_ffmpeg(cmd_ffmpeg, media_file, settings, job)
+
+
+def can_mux_directly(media_file):
+    """Check whether FFmpeg can copy all non-video streams of a file straight into Matroska."""
+    if os.path.splitext(media_file)[1].lower() == '.avi':
+        # AVI packets often lack timestamps, which FFmpeg can't stream copy into MKV
+        return False
+    probe = probe_file(media_file)
+    if probe is None:
+        return False
+    for stream in probe.get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type in ['video', 'attachment']:
+            continue
+        if stream.get('codec_name') not in direct_mux_codecs.get(codec_type, []):
+            return False
+    return True
+
+
+def is_audio_transcoded(stream):
+    """Whether the audio stage transcodes this ffprobe stream, see audio_transcode_sources."""
+    return (stream.get('codec_type') == 'audio'
+            and stream.get('codec_name', '').split('_')[0] in audio_transcode_sources)
+
+
+def get_audio_transcodes(media_file):
+    """The ffprobe streams of media_file the audio stage transcodes."""
+    probe = probe_file(media_file) or {}
+    return [stream for stream in probe.get('streams', []) if is_audio_transcoded(stream)]
+
+
+def get_audio_bitrate(audio_codec, channels):
+    """Target bitrate in kbit/s for a track with this many channels."""
+    channels = channels or 2
+    return audio_bitrates[audio_codec].get(channels, audio_bitrate_per_channel[audio_codec] * channels)
+
+
+def transcode_audio_track(media_file, stream, output_file, audio_codec, job=None):
+    """
+    Encode one audio stream of media_file to output_file (Matroska audio). Returns True on success.
+    Stops when job (the file's EncodeJob) does, and fails the job if the transcode fails.
+    """
+    channels = stream.get('channels') or 2
+    cmd_ffmpeg = [ffmpeg, '-y', '-nostats', '-loglevel', 'error', '-i', media_file,
+                  '-map', f"0:{stream['index']}",
+                  '-c:a', audio_encoders[audio_codec],
+                  '-b:a', f'{get_audio_bitrate(audio_codec, channels)}k']
+    if audio_codec == 'opus' and channels > 2:
+        # libopus only accepts the standard surround layouts, e.g. 5.1 but not 5.1(side)
+        cmd_ffmpeg.extend(['-af', 'aformat=channel_layouts=7.1|5.1|stereo', '-mapping_family', '1'])
+    cmd_ffmpeg.append(output_file)
+    return_code, stderr = run_ffmpeg_process(cmd_ffmpeg, job, capture_stderr=True, job_stats=False)
+    if return_code != 0:
+        if job and job.stopping:
+            return False
+        print(f"Error transcoding audio track {stream['index']} of '{media_file}':\n{stderr}")
+        if job:
+            # No point in finishing the video without this track
+            job.failed = f"audio track {stream['index']} failed"
+        return False
+    return True
+
+
+def build_track_order(media_file, audio_tracks):
+    """
+    The mkvmerge --track-order for merging the encoded video (file 0), the source (file 1)
+    and one file per transcoded audio track (files 2, 3, ...), so every transcoded track
+    takes the place of its original. This relies on mkvmerge's track IDs matching the
+    ffprobe stream indexes, as they do for Matroska and MP4 sources.
+    """
+    transcoded = {stream['index']: file_id for file_id, stream in enumerate(audio_tracks, start=2)}
+    track_order = ['0:0']
+    for stream in (probe_file(media_file) or {}).get('streams', []):
+        if stream.get('codec_type') in ['audio', 'subtitle']:
+            index = stream['index']
+            track_order.append(f"{transcoded[index]}:0" if index in transcoded else f"1:{index}")
+    return ','.join(track_order)
+
+
+def estimate_job_space(media_file, settings):
+    """
+    Rough peak disk space needed to encode media_file. Returns a dict of directory -> bytes
+    for the output folder and the temporary files folder (the same folder without a scratch
+    volume). Nothing is ever estimated above the size of the source plus the margin.
+    """
+    source_size = os.path.getsize(media_file)
+    source_video = max(0, source_size - get_non_video_bytes(media_file))
+    crf = int(settings['quality']) if settings['quality'].isdigit() else 18
+    ratio = output_size_ratios.get(settings['codec'], 1.0) * 2 ** (-(crf - 18) / 6)
+    video = min(source_video, source_video * ratio * output_size_margin)
+    non_video = source_size - source_video
+    if settings['audio_codec']:
+        non_video = min(non_video, get_non_video_bytes(media_file, settings['audio_codec']))
+    output = min(source_size, video + non_video)
+
+    if (settings['direct_mux'] and not settings['segmented'] and can_mux_directly(media_file)
+            and not (settings['audio_codec'] and get_audio_transcodes(media_file))):
+        # FFmpeg writes the final file next to its destination
+        return {'output': output, 'temp': 0}
+    temp = video
+    if settings['segmented']:
+        # Stream-copied source chunks, encoded chunks and the joined video
+        temp += source_video + video
+    return {'output': output, 'temp': temp}
+
+
+class DiskSpaceGuard:
+    """
+    Admission control for new jobs. A job only starts when its estimated space fits in the
+    free space of the output and temp filesystems, minus what the running jobs have reserved
+    (they may not have written it yet) and disk_space_reserve. Reservations are released
+    when a job ends.
+    """
+
+    def __init__(self, output_dir, temp_dir):
+        self.dirs = {'output': output_dir, 'temp': temp_dir or output_dir}
+        self.reserved = {}
+
+    def try_reserve(self, media_file, settings):
+        """Reserve space for a job. Returns None if it fits, otherwise a description of what is missing."""
+        needed = estimate_job_space(media_file, settings)
+        # Output and temp may well be the same filesystem
+        per_device = {}
+        for kind, size in needed.items():
+            device = os.stat(self.dirs[kind]).st_dev
+            path, total = per_device.get(device, (self.dirs[kind], 0))
+            per_device[device] = (path, total + size)
+
+        for device, (path, size) in per_device.items():
+            reserved = sum(r.get(device, 0) for r in self.reserved.values())
+            free = shutil.disk_usage(path).free - reserved - disk_space_reserve
+            if size > free:
+                return (f"needs about {size / 1024 ** 3:.1f} GiB on '{path}', "
+                        f"{max(0, free) / 1024 ** 3:.1f} GiB available")
+        self.reserved[media_file] = {device: size for device, (path, size) in per_device.items()}
+        return None
+
+    def release(self, media_file):
+        self.reserved.pop(media_file, None)
+
+
+def delete_empty_temp_dirs(temp_subdir, temp_dir):
+    """Remove the now empty folders below the scratch folder, but never the scratch folder itself."""
+    temp_dir = os.path.abspath(temp_dir)
+    current = os.path.abspath(temp_subdir)
+    with cleanup_lock:
+        while current != temp_dir and current.startswith(temp_dir + os.sep):
+            try:
+                os.rmdir(current)
+            except OSError:
                 break
-        if has_media_files:
-            # There are media files left, stop
-            break
+            current = os.path.dirname(current)
+
+
+def finish_media_file(media_file, journal=None):
+    """Remove the source once its output is complete. Its folder is cleaned up by MediaDirCleanup."""
+    if journal:
+        journal.update(media_file, 'done')
+    os.remove(media_file)
+    if journal:
+        journal.remove(media_file)
+
+
+def encode_media_file(media_file, input_dir, output_dir, settings, number_of_threads, crop_groups=None,
+                      journal=None, job=None, temp_prefix='temp_'):
+    """
+    Encode, merge and clean up a single media file. Returns True on success.
+    crop_groups (a CropGroups) provides the crop shared by the file's group in 'group' crop mode.
+    The journal records each step, so an interrupted job can pick up where it stopped,
+    and job (an EncodeJob) collects the throughput statistics of the FFmpeg runs.
+    Temporary files are named temp_prefix + name; workers sharing a queue each use their own
+    prefix, so a worker that lost a file to another one never touches the new owner's files.
+    """
+    entry = journal.get(media_file) if journal else None
+    if entry and entry.get('state') == 'done':
+        # The output was completed before the last run was interrupted
+        finish_media_file(media_file, journal)
+        return True
+    if entry and entry.get('state') == 'skipped' and settings['min_savings']:
+        # Already found not worth encoding, and the file hasn't changed since
+        return skip_media_file(media_file, entry.get('reason'), job=job)
+
+    if job:
+        job.set_phase('analyzing')
+    # Get original dimensions
+    orig_width, orig_height = get_video_dimensions(media_file)
+    if orig_width is None or orig_height is None:
+        return False  # skip this file
+
+    cropping = settings['cropping']
+    resizing = settings['resizing']
+
+    # **Compute Cropped Dimensions (if cropping is enabled)**
+    if cropping:
+        if settings['crop_values'] in ['auto', 'group']:
+            if settings['crop_values'] == 'group' and crop_groups:
+                auto_crop_values = crop_groups.crop_for(media_file)
+            else:
+                auto_crop_values = auto_crop(media_file)
+            left, right, top, bottom = map(int, auto_crop_values.split(','))
         else:
-            # No media files, delete directory regardless of other files
-            shutil.rmtree(media_dir)
-            # Move up one level
-            media_dir = os.path.dirname(media_dir)
-            media_dir = os.path.abspath(media_dir)
-    return
+            left, right, top, bottom = settings['crop_values']
+        cropped_width = orig_width - left - right
+        cropped_height = orig_height - top - bottom
+        if cropped_width <= 0 or cropped_height <= 0:
+            print(f"Cropped dimensions are invalid for file {media_file}. Skipping.")
+            return False
+
+    # **Construct Filter Chain Based on User Choices**
+    filter_chain = []
+    if cropping:
+        # Crop filter
+        crop_filter = f"crop=w=iw-{left}-{right}:h=ih-{top}-{bottom}:x={left}:y={top}"
+        filter_chain.append(crop_filter)
+    if resizing:
+        scale_filter = f"scale=w={settings['custom_width']}:h={settings['custom_height']}"
+        filter_chain.append(scale_filter)
+
+    # Build filter string
+    filter_str = ",".join(filter_chain) if filter_chain else None
+
+    # Determine relative path
+    rel_path = os.path.relpath(media_file, input_dir)
+    rel_dir = os.path.dirname(rel_path)
+    # Create corresponding directory in output_dir
+    output_subdir = os.path.join(output_dir, rel_dir)
+    os.makedirs(output_subdir, exist_ok=True)
+
+    # **Build Output Filename**
+    basename = build_output_basename(media_file, settings['codec_display_name'])
+    output_file = os.path.join(output_subdir, basename + '.mkv')
+    if journal:
+        output_file = journal.claim_output(media_file, output_file)
+    if job:
+        job.output_file = output_file
+
+    # Temporary files go to the scratch folder if there is one. The single-pass output is the
+    # exception, it is written next to its destination so it can be renamed into place.
+    temp_subdir = os.path.join(settings['temp_dir'], rel_dir) if settings['temp_dir'] else output_subdir
+    os.makedirs(temp_subdir, exist_ok=True)
+    temp_video_file = os.path.join(temp_subdir, temp_prefix + os.path.basename(media_file))
+    work_dir_prefix = os.path.join(temp_subdir, '.' + temp_prefix + os.path.splitext(os.path.basename(media_file))[0])
+
+    # **Target-quality CRF Search**
+    if settings['quality'] == 'auto':
+        if job:
+            job.set_phase('searching CRF')
+        crf = choose_crf(media_file, filter_str, settings, work_dir_prefix + '_crf')
+        if crf is None:
+            return False
+        settings = {**settings, 'quality': str(crf)}
+        if job:
+            job.settings = settings
+
+    # **Output Size Check**
+    # Predict the size from a few sample clips before spending hours on the encode,
+    # and stop encodes whose running size shows they will end up larger than the source
+    source_size = os.path.getsize(media_file)
+    duration = job.duration if job else get_media_duration(media_file)
+    check_size = settings['min_savings'] and duration
+    if check_size and not (entry and entry.get('state') in ['encoding', 'muxing']):
+        if job:
+            job.set_phase('predicting size')
+        predicted_size = predict_output_size(media_file, filter_str, settings, work_dir_prefix + '_size')
+        if predicted_size:
+            if job:
+                job.predicted_size = predicted_size
+            savings = 100 * (1 - predicted_size / source_size)
+            if savings < settings['min_savings']:
+                reason = (f"predicted to save only {savings:.0f}% "
+                          f"({predicted_size / 1024 ** 3:.2f} of {source_size / 1024 ** 3:.2f} GiB)")
+                if settings['size_check'] == 'skip':
+                    return skip_media_file(media_file, reason, journal, job)
+                console.print(f"Warning: {os.path.basename(media_file)} is {reason}", style="yellow",
+                              highlight=False)
+
+    # **Audio Transcoding**
+    # Lossless and DTS tracks are encoded on their own threads while the video encodes,
+    # so they only add to the merge, which always goes through mkvmerge then
+    audio_tracks = get_audio_transcodes(media_file) if settings['audio_codec'] else []
+    audio_files = [f"{work_dir_prefix}_audio_{stream['index']}.mka" for stream in audio_tracks]
+
+    merged = False
+    resume_mux = (entry and entry.get('state') == 'muxing' and os.path.exists(temp_video_file)
+                  and all(os.path.exists(audio_file) for audio_file in audio_files))
+    # **Single-pass Encode and Mux**
+    # FFmpeg writes the final MKV in one go, which saves writing and re-reading a
+    # full-size temporary video file. Files FFmpeg can't mux cleanly (and chunked
+    # encodes) go through the mkvmerge path below instead.
+    if (settings['direct_mux'] and not settings['segmented'] and not audio_tracks and not resume_mux
+            and can_mux_directly(media_file)):
+        temp_output_file = os.path.join(output_subdir, temp_prefix + os.path.basename(output_file))
+        cmd_ffmpeg = build_ffmpeg_command(media_file, temp_output_file, filter_str, settings, number_of_threads,
+                                          direct_mux=True)
+        if journal:
+            journal.update(media_file, 'encoding', temp_files=[temp_output_file])
+        if job:
+            job.set_phase('encoding')
+            if check_size:
+                job.watch_size(source_size / duration * size_abort_margin)
+        if run_ffmpeg(cmd_ffmpeg, media_file, settings, job) and not (job and job.lease_lost):
+            os.replace(temp_output_file, output_file)
+            merged = True
+        else:
+            if os.path.exists(temp_output_file):
+                os.remove(temp_output_file)
+            if job and job.lease_lost:
+                # The file is now the other worker's, and must not be marked as skipped
+                return False
+            if job and job.skipped:
+                return skip_media_file(media_file, job.skipped, journal, job)
+            print(f"Retrying '{media_file}' with a separate mkvmerge step.")
+
+    if not merged:
+        # **Start Video Encoding**
+        if resume_mux:
+            console.print(f"Resuming {os.path.basename(media_file)} at the merge step", highlight=False)
+        else:
+            if journal:
+                journal.update(media_file, 'encoding', temp_files=[temp_video_file] + audio_files)
+            if job:
+                job.set_phase('encoding')
+            if job and check_size:
+                # Only the video is encoded here, so compare with the source's video alone
+                job.watch_size((source_size - get_non_video_bytes(media_file)) / duration * size_abort_margin)
+            with ThreadPoolExecutor(max_workers=max(1, len(audio_tracks))) as audio_pool:
+                audio_jobs = [audio_pool.submit(transcode_audio_track, media_file, stream, audio_file,
+                                                settings['audio_codec'], job)
+                              for stream, audio_file in zip(audio_tracks, audio_files)]
+                if settings['segmented']:
+                    encoded = encode_segmented(media_file, temp_video_file, filter_str, settings,
+                                               number_of_threads, journal, job)
+                else:
+                    cmd_ffmpeg = build_ffmpeg_command(media_file, temp_video_file, filter_str, settings,
+                                                      number_of_threads)
+                    encoded = run_ffmpeg(cmd_ffmpeg, media_file, settings, job)
+                if not encoded and job and not job.stopping:
+                    # Stop the audio transcodes instead of waiting for them to finish
+                    job.failed = "video encode failed"
+            if not all(audio_job.result() for audio_job in audio_jobs):
+                encoded = False
+            if not encoded or (job and job.lease_lost):
+                if job and job.skipped:
+                    for temp_file in [temp_video_file] + audio_files:
+                        if os.path.exists(temp_file):
+                            os.remove(temp_file)
+                    if job.lease_lost:
+                        # The file is now the other worker's, and must not be marked as skipped
+                        return False
+                    return skip_media_file(media_file, job.skipped, journal, job)
+                return False
+
+        # **Build MKVMerge Command to Merge Re-encoded Video with Original Audio/Subtitles**
+        cmd_mkvmerge = [mkvmerge, '-o', output_file, temp_video_file, '--no-video']
+        if audio_tracks:
+            # Leave out the originals of the transcoded tracks
+            cmd_mkvmerge.extend(['--audio-tracks', '!' + ','.join(str(stream['index']) for stream in audio_tracks)])
+        cmd_mkvmerge.append(media_file)
+        if audio_tracks:
+            cmd_mkvmerge.extend(audio_files)
+            cmd_mkvmerge.extend(['--track-order', build_track_order(media_file, audio_tracks)])
+        # **Start Merging Process**
+        if job:
+            job.set_phase('merging')
+        if journal:
+            journal.update(media_file, 'muxing', temp_files=[temp_video_file] + audio_files)
+        try:
+            subprocess.run(cmd_mkvmerge, check=True, text=True, capture_output=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error merging files for {media_file}:\n{e.stderr}")
+            return False
+        for temp_file in [temp_video_file] + audio_files:
+            os.remove(temp_file)
+
+    # Clean up
+    finish_media_file(media_file, journal)
+    if settings['temp_dir']:
+        delete_empty_temp_dirs(temp_subdir, settings['temp_dir'])
+
+    if settings['ffmpeg_ui'] in ["quiet", "dashboard"]:
+        console.print(f"Finished {os.path.basename(output_file)}", style="green", highlight=False)
+    return True
+
+
+def run_encode_queue(input_dir, output_dir, media_extensions, settings, settings_for_file=None, watch=False,
+                     metrics_log=None, metrics_port=None, worker=None):
+    """
+    Encode every stable media file in input_dir, keeping up to settings['concurrent_jobs']
+    encodes running at once. A job merges and cleans up on its own worker as soon as its
+    encode finishes, so other jobs keep encoding in the meantime.
+    settings_for_file(media_file) can return per-file settings (e.g. directory overrides),
+    and with watch=True the queue keeps waiting for new files instead of exiting.
+    The throughput of every file is appended to metrics_log (default: in output_dir), and
+    with metrics_port the totals are served in the Prometheus text format.
+    With a worker name, the queue is shared with other workers (on this or other hosts)
+    using the same input and output folders: each file is leased before it is started,
+    see EncodeLeases, and every worker keeps its own journal.
+    """
+    concurrent_jobs = settings['concurrent_jobs']
+
+    def threads_for(file_settings):
+        # In segmented mode every file runs several chunk encodes at once
+        running_encodes = concurrent_jobs * (file_settings['segment_jobs'] if file_settings['segmented'] else 1)
+        return calculate_encoder_threads(file_settings['codec'], file_settings['cpu_usage_percentage'],
+                                         running_encodes), running_encodes
+
+    number_of_threads, running_encodes = threads_for(settings)
+    if number_of_threads:
+        job_word = "encode" if running_encodes == 1 else "encodes"
+        print(f"\nUsing {number_of_threads} encoder thread(s) each for {running_encodes} concurrent {job_word}.")
+
+    queued_files = set()
+    pending_files = EncodeQueue(input_dir, settings['queue_order'])
+    running_jobs = {}
+    # Shared crop per (folder, width, height) group
+    crop_groups = CropGroups()
+
+    leases = None
+    # Files other workers are encoding, and when to check their leases again
+    leased_elsewhere = {}
+    if worker:
+        leases = EncodeLeases(input_dir, output_dir, worker)
+        if not leases.claim_worker_name():
+            print(f"Another worker named '{worker}' is already sharing '{input_dir}'. "
+                  f"Give each worker its own name with --worker NAME.")
+            leases.close()
+            sys.exit(1)
+        print(f"\nRunning as worker '{leases.owner}', sharing the queue in '{input_dir}'.")
+        journal = EncodeJournal(os.path.join(output_dir, journal_file.replace('.json', f'-{worker}.json')),
+                                leases.reserve_output)
+        temp_prefix = f'temp_{worker}_'
+    else:
+        journal = EncodeJournal(os.path.join(output_dir, journal_file))
+        temp_prefix = 'temp_'
+    disk_space = DiskSpaceGuard(output_dir, settings['temp_dir'])
+    # Files that don't fit on disk yet are left out of the queue, so the files behind them
+    # can start, and tried again once a running job has ended and freed its space
+    waiting_for_space = set()
+    space_warned = set()
+    space_freed = False
+    resumable = journal.recover(leases.in_use if leases else None)
+    if resumable:
+        print(f"\nResuming {resumable} unfinished file(s) from the previous run.")
+
+    metrics = EncodeMetrics(metrics_log or os.path.join(output_dir, metrics_log_file))
+    metrics_server = None
+    if metrics_port:
+        try:
+            metrics_server = metrics.serve(metrics_port)
+        except OSError as e:
+            print(f"Unable to serve metrics on port {metrics_port}: {e}")
+            sys.exit(1)
+        print(f"\nServing encoder metrics on http://localhost:{metrics_port}/metrics")
+
+    # Rich redraws the table on its own thread, a few times per second at most
+    dashboard = None
+    if settings['ffmpeg_ui'] == 'dashboard':
+        dashboard = Live(get_renderable=EncodeDashboard(metrics).render, console=console, refresh_per_second=2,
+                         transient=True)
+
+    def run_job(media_file, file_settings, number_of_threads):
+        job = metrics.start_job(media_file, file_settings, number_of_threads)
+        if leases:
+            leases.attach(media_file, job)
+        success = False
+        try:
+            success = encode_media_file(media_file, input_dir, output_dir, file_settings, number_of_threads,
+                                        crop_groups, journal, job, temp_prefix)
+        finally:
+            metrics.finish_job(job, success)
+            if leases and not leases.release(media_file):
+                # The file and its temporary files belong to the worker that took it over
+                journal.remove(media_file)
+        if success:
+            media_dirs.done(media_file)
+        return success
+
+    watcher = InputWatcher(input_dir)
+    media_dirs = MediaDirCleanup(input_dir, watcher.settle_time)
+    if not watch and not any(is_media_file(f, media_extensions) for f in watcher.files):
+        print("No media files found in the input directory.")
+        watcher.close()
+        sys.exit(1)
+
+    if dashboard:
+        dashboard.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent_jobs) as executor:
+            while True:
+                # Hand newly stable media files straight to the queue. queued_files holds the
+                # files that are pending or running. Files that failed are left in the input
+                # folder, and the watcher only reports them again once they are replaced.
+                if running_jobs or space_freed:
+                    poll_timeout = 0
+                elif waiting_for_space:
+                    poll_timeout = disk_space_poll_interval
+                elif leased_elsewhere:
+                    poll_timeout = max(0, min(leased_elsewhere.values()) - time.monotonic())
+                else:
+                    poll_timeout = None
+                stable_files = watcher.poll(timeout=poll_timeout)
+                # Count files still being copied too, so their folder is never removed under them
+                media_dirs.sync(watcher.files, media_extensions)
+                media_dirs.flush(media_extensions)
+                new_files = [f for f in stable_files
+                             if is_media_file(f, media_extensions) and f not in queued_files]
+                queued_files.update(new_files)
+                pending_files.add(new_files)
+                crop_groups.add(new_files)
+                # With nothing running, only files deleted elsewhere can free space (watch mode
+                # waits disk_space_poll_interval for that)
+                if waiting_for_space and (space_freed or not running_jobs):
+                    pending_files.add(list(waiting_for_space))
+                    waiting_for_space.clear()
+                space_freed = False
+                # Look again at files other workers were on, in case they finished, failed or died
+                for media_file, check_time in list(leased_elsewhere.items()):
+                    if time.monotonic() >= check_time:
+                        del leased_elsewhere[media_file]
+                        if os.path.exists(media_file):
+                            pending_files.add([media_file])
+                        else:
+                            queued_files.discard(media_file)
+
+                while pending_files and len(running_jobs) < concurrent_jobs:
+                    media_file = pending_files.peek()
+                    file_settings = settings
+                    if settings_for_file:
+                        try:
+                            file_settings = settings_for_file(media_file)
+                        except ValueError as e:
+                            pending_files.remove(media_file)
+                            queued_files.discard(media_file)
+                            print(f"Invalid settings for '{media_file}': {e}. Skipping file.")
+                            continue
+                    if not os.path.exists(media_file):
+                        pending_files.remove(media_file)
+                        queued_files.discard(media_file)
+                        continue
+
+                    # Only start a file once there is room for its temporary and output files
+                    shortage = disk_space.try_reserve(media_file, file_settings)
+                    if shortage:
+                        pending_files.remove(media_file)
+                        if running_jobs or watch:
+                            if media_file not in space_warned:
+                                print(f"Waiting for disk space before starting '{media_file}': {shortage}")
+                                space_warned.add(media_file)
+                            waiting_for_space.add(media_file)
+                            continue
+                        # Nothing running will free up space
+                        queued_files.discard(media_file)
+                        space_warned.discard(media_file)
+                        print(f"Not enough disk space for '{media_file}': {shortage}. Skipping file.")
+                        continue
+                    pending_files.remove(media_file)
+                    space_warned.discard(media_file)
+                    if leases and not leases.claim(media_file):
+                        disk_space.release(media_file)
+                        leased_elsewhere[media_file] = time.monotonic() + lease_heartbeat_interval
+                        continue
+                    if leases and not os.path.exists(media_file):
+                        # Finished by another worker just before the claim
+                        leases.release(media_file)
+                        disk_space.release(media_file)
+                        queued_files.discard(media_file)
+                        continue
+                    if journal.get(media_file) is None:
+                        journal.update(media_file, 'queued')
+                    future = executor.submit(run_job, media_file, file_settings, threads_for(file_settings)[0])
+                    running_jobs[future] = media_file
+                    pending_files.started(media_file)
+                metrics.queued_files = len(pending_files)
+
+                if (not watch and not running_jobs and not pending_files and not leased_elsewhere
+                        and not waiting_for_space and not watcher.has_unstable_files()):
+                    break
+
+                if running_jobs:
+                    done, _ = wait(running_jobs, timeout=watcher.settle_time, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        media_file = running_jobs.pop(future)
+                        disk_space.release(media_file)
+                        space_freed = True
+                        crop_groups.remove(media_file)
+                        queued_files.discard(media_file)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            print(f"Unexpected error while processing '{media_file}': {e}")
+    finally:
+        if dashboard:
+            dashboard.stop()
+        if leases:
+            leases.close()
+        watcher.close()
+        if metrics_server:
+            metrics_server.shutdown()
+
+
+def run_benchmark_encode(codec, encoder_speed, number_of_threads, concurrent_jobs):
+    """
+    Encode the benchmark clip concurrent_jobs times at once with number_of_threads each.
+    Returns the aggregate fps, the CPU cores kept busy and the fps per busy core.
+    """
+    settings = {'codec': codec, 'encoder_speed': encoder_speed, 'quality': '18', 'tune_option': '',
+                'user_custom_ffmpeg': ''}
+    cmd_ffmpeg = build_ffmpeg_command(benchmark_source, '-', None, settings, number_of_threads)
+    input_index = cmd_ffmpeg.index('-i')
+    cmd_ffmpeg[input_index:input_index] = ['-f', 'lavfi']
+    cmd_ffmpeg[-1:-1] = ['-frames:v', str(benchmark_frames), '-f', 'null']
+    cmd_ffmpeg = cmd_ffmpeg[:1] + ['-nostats', '-loglevel', 'error'] + cmd_ffmpeg[1:]
+
+    duration = benchmark_frames / 24
+    jobs = [EncodeJob('benchmark', settings, number_of_threads, duration) for _ in range(concurrent_jobs)]
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrent_jobs) as executor:
+        results = list(executor.map(lambda job: run_ffmpeg_process(cmd_ffmpeg, job, capture_stderr=True), jobs))
+    wall_time = time.monotonic() - start_time
+    for return_code, stderr in results:
+        if return_code != 0:
+            raise RuntimeError(f"Benchmark encode failed:\n{stderr}")
+
+    fps = sum(job.frames for job in jobs) / wall_time
+    cpu_cores = fps_per_core = None
+    if all(job.cpu_time_known for job in jobs):
+        cpu_cores = sum(job.cpu_time for job in jobs) / wall_time
+        fps_per_core = fps / cpu_cores if cpu_cores else None
+    return {
+        'codec': codec,
+        'speed': encoder_speed,
+        'jobs': concurrent_jobs,
+        'threads': number_of_threads,
+        'fps': round(fps, 2),
+        'cpu_cores': round(cpu_cores, 2) if cpu_cores is not None else None,
+        'fps_per_core': round(fps_per_core, 3) if fps_per_core is not None else None,
+    }
+
+
+def run_benchmark(codec_names):
+    """
+    Benchmark the encoders on this machine: thread scaling of a single encode, several
+    encodes sharing the cores, and the other speeds at the best configuration. The best
+    configuration per codec is saved and replaces the built-in thread heuristics.
+    """
+    codecs = benchmark_codecs
+    if codec_names:
+        unknown = [name for name in codec_names if name not in codec_map]
+        if unknown:
+            print(f"Unsupported codec(s): {', '.join(unknown)}. Use one of: {', '.join(codec_map)}")
+            sys.exit(1)
+        codecs = list(dict.fromkeys(codec_map[name] for name in codec_names))
+
+    num_cores = os.cpu_count() or 1
+    thread_counts = sorted({t for t in [2, 4, 8, 16, 32, 64] if t < num_cores} | {num_cores})
+    job_counts = [j for j in [2, 3, 4, 6, 8, 12, 16] if num_cores // j >= 2]
+    tuning = {'cores': num_cores, 'frames': benchmark_frames, 'source': benchmark_source, 'codecs': {},
+              'results': []}
+
+    print(f"\nBenchmarking on {num_cores} logical cores with {benchmark_frames} frames of synthetic 1080p video.")
+    for codec in codecs:
+        speeds = benchmark_speeds[codec]
+        display_name = codec_display_name_map.get(codec, codec)
+        table = Table(title=f"{display_name} ({', '.join(speeds)})", title_justify='left')
+        for column in ['Speed', 'Jobs', 'Threads', 'FPS', 'CPU cores', 'FPS per core']:
+            table.add_column(column, justify='right')
+
+        def measure(encoder_speed, number_of_threads, concurrent_jobs):
+            console.print(f"{display_name} {encoder_speed}: {concurrent_jobs} job(s) x {number_of_threads} "
+                          f"thread(s)", style="bright_black", highlight=False)
+            result = run_benchmark_encode(codec, encoder_speed, number_of_threads, concurrent_jobs)
+            table.add_row(result['speed'], str(result['jobs']), str(result['threads']), f"{result['fps']:.1f}",
+                          f"{result['cpu_cores']:.1f}" if result['cpu_cores'] is not None else "-",
+                          f"{result['fps_per_core']:.2f}" if result['fps_per_core'] is not None else "-")
+            tuning['results'].append(result)
+            return result
+
+        try:
+            scaling = [measure(speeds[0], t, 1) for t in thread_counts]
+            sharing = [measure(speeds[0], num_cores // j, j) for j in job_counts]
+            best = max(scaling + sharing, key=lambda r: r['fps'])
+            for encoder_speed in speeds[1:]:
+                measure(encoder_speed, best['threads'], best['jobs'])
+        except RuntimeError as e:
+            print(e)
+            continue
+        console.print(table)
+
+        # The fewest threads reaching 95% of the best single-encode fps; more threads mostly wait
+        best_single = max(r['fps'] for r in scaling)
+        max_threads = min(r['threads'] for r in scaling if r['fps'] >= 0.95 * best_single)
+        tuning['codecs'][codec] = {
+            'divisor': round(num_cores / (best['threads'] * best['jobs']), 3),
+            'max_threads': max(max_threads, best['threads']),
+            'concurrent_jobs': best['jobs'],
+        }
+        console.print(f"Best: {best['jobs']} job(s) x {best['threads']} thread(s) at {best['fps']:.1f} fps\n",
+                      style="green", highlight=False)
+
+    if not tuning['codecs']:
+        sys.exit(1)
+    tuning_path = get_encoder_tuning_path()
+    # Keep the tuning of codecs that were not part of this run
+    previous = load_encoder_tuning_file()
+    if previous.get('cores') == num_cores:
+        tuning['codecs'] = {**previous.get('codecs', {}), **tuning['codecs']}
+    with open(tuning_path, 'w', encoding='utf-8') as f:
+        json.dump(tuning, f, indent=2)
+    print(f"Saved the tuned encoder settings to '{tuning_path}'.")
+
+
+def load_profiles(profiles_file):
+    """Read the [profiles.<name>] tables from a TOML profiles file."""
+    if tomllib is None:
+        print("Profile mode requires Python 3.11 or newer (tomllib).")
+        sys.exit(1)
+    try:
+        with open(profiles_file, 'rb') as f:
+            return tomllib.load(f).get('profiles', {})
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        print(f"Unable to read profiles file '{profiles_file}': {e}")
+        sys.exit(1)
+
+
+def build_settings(options):
+    """
+    Turn profile options (see profile_defaults) into the same settings the interactive
+    prompts produce, so both modes build an identical FFmpeg command. Raises ValueError.
+    """
+    options = {**profile_defaults, **options}
+
+    crop = str(options['crop']).strip().lower()
+    cropping = crop not in ['none', 'no', '']
+    crop_values = None
+    if crop in ['auto', 'group']:
+        crop_values = crop
+    elif cropping:
+        try:
+            crop_values = tuple(map(int, crop.split(',')))
+        except ValueError:
+            crop_values = ()
+        if len(crop_values) != 4:
+            raise ValueError(f"invalid crop values '{options['crop']}'")
+
+    resolution = str(options['resolution']).strip().lower()
+    custom_width = custom_height = None
+    if resolution == '1080p':
+        custom_width, custom_height = 1920, -2
+    elif resolution == '720p':
+        custom_width, custom_height = 1280, -2
+    elif resolution:
+        try:
+            custom_width, custom_height = map(int, resolution.split('x'))
+        except ValueError:
+            raise ValueError(f"invalid resolution '{options['resolution']}'")
+
+    codec_input = str(options['codec'])
+    if codec_input not in codec_map:
+        raise ValueError(f"unsupported codec '{codec_input}', use one of: {', '.join(codec_map)}")
+    codec = codec_map[codec_input]
+
+    quality = str(options['quality'])
+    if not quality.isdigit() and quality != 'auto':
+        raise ValueError(f"invalid quality setting '{quality}'")
+    quality_metric = str(options['quality_metric']).lower()
+    if quality_metric not in crf_search_targets:
+        raise ValueError(f"invalid quality metric '{options['quality_metric']}', use 'vmaf' or 'ssim'")
+    quality_target = options['quality_target']
+    try:
+        quality_target = float(quality_target) if quality_target != '' else crf_search_targets[quality_metric]
+    except ValueError:
+        raise ValueError(f"invalid quality target '{options['quality_target']}'")
+    if quality == 'auto' and quality_metric == 'vmaf' and not ffmpeg_has_filter('libvmaf'):
+        raise ValueError("this FFmpeg build has no libvmaf, use quality_metric = 'ssim'")
+
+    tune_option = str(options['tune'])
+    if tune_option and tune_option not in codec_tune_options.get(codec, []):
+        raise ValueError(f"invalid tune option '{tune_option}' for codec {codec_input}")
+
+    encoder_speed = str(options['speed'])
+    if codec in ['libx264', 'libx265']:
+        encoder_speed = encoder_speed or ('slow' if tune_option == 'grain' else 'medium')
+        valid_speeds = ["slow", "medium"]
+    else:
+        encoder_speed = encoder_speed or '4'
+        valid_speeds = [str(i) for i in range(9)]
+    if encoder_speed not in valid_speeds:
+        raise ValueError(f"invalid speed '{encoder_speed}' for codec {codec_input}")
+
+    cpu_usage_percentage = options['cpu_usage']
+    if cpu_usage_percentage != 'auto':
+        try:
+            cpu_usage_percentage = float(cpu_usage_percentage)
+        except ValueError:
+            cpu_usage_percentage = 0
+        if not 0 < cpu_usage_percentage <= 1000:
+            raise ValueError(f"invalid CPU usage percentage '{options['cpu_usage']}'")
+
+    concurrent_jobs = options['concurrent_jobs']
+    if concurrent_jobs == 'auto':
+        concurrent_jobs = recommended_concurrent_jobs(codec)
+    segment_length = int(options['segment_length'])
+    segment_jobs = options['segment_jobs']
+    if segment_jobs == 'auto':
+        segment_jobs = max(2, recommended_concurrent_jobs(codec))
+    if int(concurrent_jobs) < 1 or segment_length < 0 or int(segment_jobs) < 1:
+        raise ValueError("invalid job or chunk settings")
+
+    try:
+        min_savings = float(options['min_savings'])
+    except ValueError:
+        raise ValueError(f"invalid minimum savings '{options['min_savings']}'")
+    size_check = str(options['size_check']).lower()
+    if not 0 <= min_savings < 100 or size_check not in ['skip', 'flag']:
+        raise ValueError("invalid size check settings")
+
+    audio_codec = str(options['audio_codec']).lower()
+    if audio_codec and audio_codec not in audio_encoders:
+        raise ValueError(f"invalid audio codec '{options['audio_codec']}'")
+
+    queue_order = str(options['queue_order']).lower()
+    if queue_order not in queue_orders:
+        raise ValueError(f"invalid queue order '{options['queue_order']}'")
+
+    ffmpeg_ui = str(options['ui'])
+    if ffmpeg_ui not in ['quiet', 'compact', 'advanced', 'dashboard']:
+        raise ValueError(f"invalid UI '{ffmpeg_ui}'")
+    if (int(concurrent_jobs) > 1 or segment_length) and ffmpeg_ui != 'dashboard':
+        ffmpeg_ui = 'quiet'
+
+    return {
+        'cropping': cropping,
+        'crop_values': crop_values,
+        'resizing': custom_width is not None,
+        'custom_width': custom_width,
+        'custom_height': custom_height,
+        'codec': codec,
+        'codec_display_name': codec_display_name_map.get(codec, codec_input.upper()),
+        'quality': quality,
+        'quality_metric': quality_metric,
+        'quality_target': quality_target,
+        'tune_option': tune_option,
+        'encoder_speed': encoder_speed,
+        'cpu_usage_percentage': cpu_usage_percentage,
+        'concurrent_jobs': int(concurrent_jobs),
+        'segmented': segment_length > 0,
+        'segment_length': segment_length or None,
+        'segment_jobs': int(segment_jobs) if segment_length else None,
+        'direct_mux': bool(options['direct_mux']),
+        'min_savings': min_savings,
+        'size_check': size_check,
+        'audio_codec': audio_codec,
+        'temp_dir': None,
+        'user_custom_ffmpeg': str(options['custom_params']),
+        'ffmpeg_ui': ffmpeg_ui,
+        'queue_order': queue_order,
+    }
+
+
+def resolve_profile_options(media_file, input_dir, profiles, base_options):
+    """
+    Apply the directory override files (.media-encoder.toml) from input_dir down to the
+    file's own folder on top of base_options. An override can switch to another profile
+    with profile = "<name>" and/or override individual options.
+    """
+    options = dict(base_options)
+    input_dir = os.path.abspath(input_dir)
+    rel_dir = os.path.relpath(os.path.dirname(os.path.abspath(media_file)), input_dir)
+    dirs = [input_dir]
+    if rel_dir != os.curdir:
+        for part in rel_dir.split(os.sep):
+            dirs.append(os.path.join(dirs[-1], part))
+
+    for dir_path in dirs:
+        override_file = os.path.join(dir_path, directory_override_file)
+        if not os.path.isfile(override_file):
+            continue
+        try:
+            with open(override_file, 'rb') as f:
+                overrides = tomllib.load(f)
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            raise ValueError(f"unable to read '{override_file}': {e}")
+        profile_name = overrides.pop('profile', None)
+        if profile_name is not None:
+            if profile_name not in profiles:
+                raise ValueError(f"unknown profile '{profile_name}' in '{override_file}'")
+            options = dict(profiles[profile_name])
+        options.update(overrides)
+    return options
+
+
+def run_profile_mode(args, input_dir, output_dir, media_extensions):
+    """Non-interactive mode: build all settings from a named profile instead of prompting."""
+    profiles = load_profiles(args.profiles)
+    if args.profile not in profiles:
+        print(f"Profile '{args.profile}' not found in '{args.profiles}'. "
+              f"Available profiles: {', '.join(profiles) or 'none'}")
+        sys.exit(1)
+    base_options = profiles[args.profile]
+    try:
+        settings = build_settings(base_options)
+    except ValueError as e:
+        print(f"Invalid profile '{args.profile}': {e}")
+        sys.exit(1)
+
+    settings['temp_dir'] = args.temp_dir
+    if args.queue_order:
+        settings['queue_order'] = args.queue_order
+
+    def settings_for_file(media_file):
+        file_settings = build_settings(resolve_profile_options(media_file, input_dir, profiles, base_options))
+        # The number of running jobs and the scratch folder are shared by the whole queue
+        file_settings['concurrent_jobs'] = settings['concurrent_jobs']
+        file_settings['temp_dir'] = args.temp_dir
+        if settings['concurrent_jobs'] > 1 or settings['ffmpeg_ui'] == 'dashboard':
+            file_settings['ffmpeg_ui'] = settings['ffmpeg_ui']
+        return file_settings
+
+    os.makedirs(output_dir, exist_ok=True)
+    run_encode_queue(input_dir, output_dir, media_extensions, settings, settings_for_file, watch=args.watch,
+                     metrics_log=args.metrics_log, metrics_port=args.metrics_port, worker=args.worker)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Encode media files from the input folder. Without --profile, all options are prompted for."
+    )
+    parser.add_argument('--profile', help="Run non-interactively using the named profile.")
+    parser.add_argument('--profiles', default='profiles.toml',
+                        help="TOML file containing the profiles (default: profiles.toml).")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running and encode new files as they appear (profile mode only).")
+    parser.add_argument('--input', default='input', help="Input folder (default: input).")
+    parser.add_argument('--output', default='output', help="Output folder (default: output).")
+    parser.add_argument('--temp-dir',
+                        help="Folder for temporary files, e.g. on a separate fast scratch drive "
+                             "(default: the output folder).")
+    parser.add_argument('--naming-rules',
+                        help=f"TOML file with extra output naming rules (default: {naming_rules_file} if it exists).")
+    parser.add_argument('--benchmark', nargs='*', metavar='CODEC',
+                        help="Benchmark the encoders on this machine (default: h264 h265) and save the "
+                             "best thread/job settings for later runs.")
+    parser.add_argument('--metrics-log',
+                        help=f"Per-file throughput log, CSV if it ends in .csv (default: <output>/{metrics_log_file}).")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve encoder metrics in the Prometheus text format on this port.")
+    parser.add_argument('--queue-order', choices=queue_orders,
+                        help="Order to encode the files in: by path (natural, the default), shortest first, "
+                             "by folder priority, or taking turns between the top-level folders (fair). "
+                             f"Files can be pinned and priorities set in input/{queue_control_file}.")
+    parser.add_argument('--worker', nargs='?', const=platform.node(), metavar='NAME',
+                        help="Share the input folder with other workers, e.g. on other hosts with the same "
+                             "network share mounted. Each worker needs its own name (default: the host name).")
+    args = parser.parse_args()
+    if args.watch and not args.profile:
+        parser.error("--watch requires --profile")
+    if args.worker is not None and not re.fullmatch(r'[\w.-]+', args.worker):
+        parser.error("the worker name may only contain letters, digits, '.', '_' and '-'")
+    return args
 
 
 def main():
-    input_dir = 'input'
-    output_dir = 'output'
+    args = parse_arguments()
+    input_dir = args.input
+    output_dir = args.output
     media_extensions = ['.mkv', '.mp4', '.avi', '.webm']
 
-    all_files = get_all_files(input_dir)
-    if not all_files:
-        exit(2)
+    if args.benchmark is not None:
+        run_benchmark(args.benchmark)
+        return
+
+    global output_naming
+    rules_file = args.naming_rules or (naming_rules_file if os.path.isfile(naming_rules_file) else None)
+    if rules_file:
+        output_naming = NamingRules.load(rules_file)
+
+    if args.watch:
+        os.makedirs(input_dir, exist_ok=True)
+    else:
+        all_files = get_all_files(input_dir)
+        if not all_files:
+            exit(2)
+
+    if args.temp_dir:
+        os.makedirs(args.temp_dir, exist_ok=True)
+
+    if args.profile:
+        run_profile_mode(args, input_dir, output_dir, media_extensions)
+        return
 
     # **Optional Cropping**
     done = False
-    perform_auto_crop = False
+    crop_values = None
     while not done:
         perform_cropping = prompt("\nDo you want to remove any black bars in the video stream? (yes/no): ",
                                   default="yes")
         if perform_cropping in ['yes', 'y']:
             done = True
             cropping = True
-            crop_values = prompt("\nEnter crop values (left,right,top,bottom): ", default="auto")
-            if crop_values == 'auto':
-                done = True
-                perform_auto_crop = True
+            crop_input = prompt("\nEnter crop values (left,right,top,bottom): ", default="auto")
+            if crop_input == 'auto':
+                crop_values = 'auto'
+                share_crop = prompt("\nMeasure crop once per season (files sharing a folder and resolution)? "
+                                    "(yes/no): ", default="no").lower()
+                if share_crop in ['yes', 'y']:
+                    crop_values = 'group'
             else:
                 try:
-                    left, right, top, bottom = map(int, crop_values.split(','))
-                    cropping = True
+                    crop_values = tuple(map(int, crop_input.split(',')))
+                    if len(crop_values) != 4:
+                        raise ValueError
                 except ValueError:
                     print("Invalid crop values. Exiting.")
                     sys.exit(1)
         elif perform_cropping in ['no', 'n']:
             done = True
             cropping = False
-            left = right = top = bottom = 0  # Defaults, won't affect cropping if not used
 
     # **Optional Resolution Rescaling Prompt**
     resizing = False
@@ -259,49 +3445,6 @@ def main():
             print("Invalid resolution choice.")
             sys.exit(1)
 
-    # Map user-friendly codec names to ffmpeg encoder names
-    codec_map = {
-        'h264': 'libx264',
-        'h265': 'libx265',
-        'hevc': 'libx265',
-        'vp9': 'libvpx-vp9',
-        'av1': 'libaom-av1'
-    }
-
-    # Map codec to available tune options
-    codec_tune_options = {
-        'libx264': ['film', 'animation', 'grain', 'stillimage', 'fastdecode', 'zerolatency', 'psnr', 'ssim'],
-        'libx265': ['grain', 'fastdecode', 'zerolatency', 'psnr', 'ssim', 'animation'],
-        'libvpx-vp9': [],
-        'libaom-av1': ['ssim', 'psnr']
-    }
-
-    # Define encoder-specific options
-    encoder_options = {
-        'libx264': {
-            # -bf 4: Use up to 4 consecutive B-frames, increasing compression efficiency
-            # -rc-lookahead 32: Pre-scan 32 upcoming frames
-            # -aq-mode 3: Employ advanced adaptive quantization
-            # -b-pyramid normal: Allow B-frames to serve as references
-            # -coder 1: Enable CABAC entropy coding
-            'options': ['-bf', '4', '-rc-lookahead', '32', '-aq-mode', '3', '-b-pyramid', 'normal', '-coder', '1'],
-            'pix_fmt': None,
-        },
-        'libx265': {
-            # rc-lookahead=32, aq-mode=3, bframes=4
-            'options': ['-x265-params', 'rc-lookahead=32:aq-mode=3:bframes=4:no-sao=1'],
-            'pix_fmt': None,
-        },
-        'libvpx-vp9': {
-            'options': [],
-            'pix_fmt': None,
-        },
-        'libaom-av1': {
-            'options': [],
-            'pix_fmt': None,
-        },
-    }
-
     codec_input = prompt("\nEnter output codec (e.g., 'h264', 'h265', 'vp9', 'av1'): ", default="h265")
     if codec_input not in codec_map:
         print("Unsupported codec detected. Please use one of the following codecs:")
@@ -312,7 +3455,24 @@ def main():
     quality_default = '18'
     print("\nCRF 18 - Effectively transparent from source in most cases")
     print("CRF 20 - More space saving, with minimal loss to some high-level details")
-    quality = prompt("Enter quality setting (CRF): ", default=quality_default)
+    print("auto   - Search for the highest CRF per file that still meets a VMAF/SSIM target")
+    quality = prompt("Enter quality setting (CRF): ", default=quality_default).strip().lower()
+    if not quality.isdigit() and quality != 'auto':
+        print("Invalid quality setting. Exiting.")
+        sys.exit(1)
+
+    quality_metric = 'vmaf'
+    quality_target = crf_search_targets[quality_metric]
+    if quality == 'auto':
+        if not ffmpeg_has_filter('libvmaf'):
+            print("This FFmpeg build has no libvmaf, scoring the samples with SSIM instead.")
+            quality_metric = 'ssim'
+        try:
+            quality_target = float(prompt(f"Enter target {quality_metric.upper()} score: ",
+                                          default=str(crf_search_targets[quality_metric])))
+        except ValueError:
+            print("Invalid target score. Exiting.")
+            sys.exit(1)
 
     codec = codec_map[codec_input]
     available_tune_options = codec_tune_options.get(codec, [])
@@ -321,9 +3481,9 @@ def main():
     if available_tune_options:
         default_tune = ''
         print()
-        if int(quality) > 18:
+        if quality.isdigit() and int(quality) > 18:
             print("CRF is above 18. Recommending using tune 'grain' if the source video is grainy.")
-        elif int(quality) == 18:
+        elif quality.isdigit() and int(quality) == 18:
             print("CRF is set to 18. No tune needed (even with grainy source material)")
         print(f"Available tune options for {codec_input}: {', '.join(available_tune_options)}")
         tune_option = prompt("Enter tune setting (optional): ", default=default_tune)
@@ -367,23 +3527,11 @@ def main():
             print("Invalid speed (cpu-used) choice. Exiting.")
             sys.exit(1)
 
-    # Fine-tune psy-rd if using x264 or x265
-    if codec in ['libx264', 'libx265']:
-        if codec == 'libx264':
-            encoder_options[codec]['options'].extend(['-psy-rd', '3.0:0.0'])
-        elif codec == 'libx265':
-            for i, opt in enumerate(encoder_options[codec]['options']):
-                if opt == '-x265-params':
-                    encoder_options[codec]['options'][i + 1] += ':psy-rd=3:psy-rdoq=3'
-                    break
-
     # CPU usage prompt
     cpu_usage_percentage = prompt("\nEnter the maximum CPU usage percentage (e.g., '50' for 50%): ", default="auto")
 
-    # Validate CPU usage percentage and calculate number of threads
-    if cpu_usage_percentage == "auto":
-        number_of_threads = 0
-    else:
+    # Validate CPU usage percentage
+    if cpu_usage_percentage != "auto":
         try:
             cpu_usage_percentage = float(cpu_usage_percentage)
             if not 0 < cpu_usage_percentage <= 1000:
@@ -392,20 +3540,67 @@ def main():
             print("Invalid CPU usage percentage.")
             sys.exit(1)
 
-        num_cores = os.cpu_count()
-        if not num_cores:
+        if not os.cpu_count():
             print("Unable to determine the number of CPU cores.")
             sys.exit(1)
 
-        if codec.lower() == "libx265":
-            divisor = 4.5
-        else:
-            divisor = 0.8
-        number_of_threads = max(1, int(num_cores * (cpu_usage_percentage / 100) // divisor))
-        # Limit to 16 threads for x264, as recommended in some docs
-        if codec.lower() == "libx264":
-            number_of_threads = min(16, number_of_threads)
-        print(f"\nUsing {number_of_threads} encoder thread(s) based on CPU usage percentage.")
+    # Concurrent encodes prompt
+    concurrent_default = str(recommended_concurrent_jobs(codec))
+    concurrent_jobs = prompt("\nEnter the number of files to encode at the same time: ", default=concurrent_default)
+    try:
+        concurrent_jobs = int(concurrent_jobs)
+        if concurrent_jobs < 1:
+            raise ValueError
+    except ValueError:
+        print("Invalid number of concurrent encodes.")
+        sys.exit(1)
+
+    # Segmented encoding prompt
+    segmented = False
+    segment_length = segment_jobs = None
+    segment_prompt = prompt("\nDo you want to split each file into chunks and encode them in parallel? (yes/no): ",
+                            default="no").lower()
+    if segment_prompt in ['yes', 'y']:
+        try:
+            segment_length = int(prompt("\nEnter chunk length in seconds: ", default="120"))
+            segment_default = str(max(2, recommended_concurrent_jobs(codec)))
+            segment_jobs = int(prompt("Enter the number of chunks to encode at the same time: ",
+                                      default=segment_default))
+            if segment_length < 1 or segment_jobs < 1:
+                raise ValueError
+        except ValueError:
+            print("Invalid chunk settings.")
+            sys.exit(1)
+        segmented = True
+
+    # Single-pass muxing prompt
+    direct_mux_prompt = prompt("\nWrite the final MKV directly from FFmpeg, without a temporary video file? "
+                               "(yes/no): ", default="yes").lower()
+    direct_mux = direct_mux_prompt in ['yes', 'y']
+
+    # Audio transcoding prompt
+    audio_codec = prompt("\nTranscode lossless and DTS audio tracks to (opus, aac, or empty to keep them): ",
+                         default="").lower()
+    if audio_codec and audio_codec not in audio_encoders:
+        print("Invalid audio codec. Exiting.")
+        sys.exit(1)
+
+    # Size check prompt
+    size_check = 'skip'
+    try:
+        min_savings = float(prompt("\nSkip files predicted to shrink by less than this percentage "
+                                   "(0 to encode everything): ", default="0"))
+        if not 0 <= min_savings < 100:
+            raise ValueError
+    except ValueError:
+        print("Invalid percentage.")
+        sys.exit(1)
+    if min_savings:
+        size_check = prompt("Skip those files, or encode them anyway with a warning? (skip/flag): ",
+                            default="skip").lower()
+        if size_check not in ['skip', 'flag']:
+            print("Invalid choice. Exiting.")
+            sys.exit(1)
 
     # Prompt for a custom FFmpeg parameter string
     done = False
@@ -419,190 +3614,49 @@ def main():
             done = True
             user_custom_ffmpeg = ""
 
-    ffmpeg_ui = prompt("\nSelect preferred FFmpeg UI (compact, advanced): ", default="compact")
+    if concurrent_jobs > 1 or segmented:
+        # Several FFmpeg progress bars would overwrite each other, so it's either
+        # one live table of all jobs or a plain start/finish log
+        ffmpeg_ui = prompt("\nSelect preferred UI (dashboard, quiet): ", default="dashboard")
+        if ffmpeg_ui != "dashboard":
+            ffmpeg_ui = "quiet"
+    else:
+        ffmpeg_ui = prompt("\nSelect preferred FFmpeg UI (compact, advanced, dashboard): ", default="compact")
 
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Substrings to replace with codec_display_name
-    replace_substrings = ['HEVC', 'AVC', 'H.265', 'H.264', 'h264', 'h265', 'x264', 'x265', 'VC-1']
-    # Substrings to remove
-    remove_substrings = ['.REMUX', ' REMUX', 'REMUX']
-
-    # Determine codec display name for filename replacements
-    codec_display_name_map = {
-        'libx264': 'x264',
-        'libx265': 'x265',
-        'libvpx-vp9': 'VP9',
-        'libaom-av1': 'AV1'
+    settings = {
+        'cropping': cropping,
+        'crop_values': crop_values,
+        'resizing': resizing,
+        'custom_width': custom_width,
+        'custom_height': custom_height,
+        'codec': codec,
+        'codec_display_name': codec_display_name_map.get(codec, codec_input.upper()),
+        'quality': quality,
+        'quality_metric': quality_metric,
+        'quality_target': quality_target,
+        'tune_option': tune_option,
+        'encoder_speed': encoder_speed,
+        'cpu_usage_percentage': cpu_usage_percentage,
+        'concurrent_jobs': concurrent_jobs,
+        'segmented': segmented,
+        'segment_length': segment_length,
+        'segment_jobs': segment_jobs,
+        'direct_mux': direct_mux,
+        'min_savings': min_savings,
+        'size_check': size_check,
+        'audio_codec': audio_codec,
+        'temp_dir': args.temp_dir,
+        'user_custom_ffmpeg': user_custom_ffmpeg,
+        'ffmpeg_ui': ffmpeg_ui,
+        'queue_order': args.queue_order or 'natural',
     }
-    codec_display_name = codec_display_name_map.get(codec, codec_input.upper())
-
-    remaining_files = wait_for_stable_files(input_dir)
-    while remaining_files:
-        # Collect all media files recursively
-        media_files = []
-        for root, dirs, files in os.walk(input_dir):
-            for file in files:
-                if os.path.splitext(file)[1].lower() in media_extensions:
-                    full_path = os.path.join(root, file)
-                    media_files.append(full_path)
-
-        if not media_files:
-            print("No media files found in the input directory.")
-            sys.exit(1)
-
-        # Sort media_files using natural sort
-        media_files_sorted = sorted(media_files, key=lambda x: natural_sort_key(os.path.relpath(x, input_dir)))
-
-        for media_file in media_files_sorted:
-            # Get original dimensions
-            orig_width, orig_height = get_video_dimensions(media_file)
-            if orig_width is None or orig_height is None:
-                continue  # skip this file
-
-            # **Compute Cropped Dimensions (if cropping is enabled)**
-            if cropping:
-                if perform_auto_crop:
-                    auto_crop_values = auto_crop(media_file)
-                    left, right, top, bottom = map(int, auto_crop_values.split(','))
-                cropped_width = orig_width - left - right
-                cropped_height = orig_height - top - bottom
-                if cropped_width <= 0 or cropped_height <= 0:
-                    print(f"Cropped dimensions are invalid for file {media_file}. Skipping.")
-                    continue
-            else:
-                cropped_width = orig_width
-                cropped_height = orig_height
-
-            # **Compute Output Dimensions and Padding (if resizing is enabled)**
-            if resizing:
-                output_width, output_height = custom_width, custom_height
-            else:
-                # If no resizing, output dimensions are the same as cropped dimensions
-                output_width = cropped_width
-                output_height = cropped_height
-                pad_left = pad_right = pad_top = pad_bottom = 0
-                scale = False
-
-            # **Construct Filter Chain Based on User Choices**
-            filter_chain = []
-            if cropping:
-                # Crop filter
-                crop_filter = f"crop=w=iw-{left}-{right}:h=ih-{top}-{bottom}:x={left}:y={top}"
-                filter_chain.append(crop_filter)
-            if resizing:
-                scale_filter = f"scale=w={output_width}:h={output_height}"
-                filter_chain.append(scale_filter)
-
-            # Build filter string
-            filter_str = ",".join(filter_chain) if filter_chain else None
-
-            # Determine relative path
-            rel_path = os.path.relpath(media_file, input_dir)
-            rel_dir = os.path.dirname(rel_path)
-            # Create corresponding directory in output_dir
-            output_subdir = os.path.join(output_dir, rel_dir)
-            if not os.path.exists(output_subdir):
-                os.makedirs(output_subdir)
-
-            temp_video_file = os.path.join(output_subdir, 'temp_' + os.path.basename(media_file))
-
-            cmd_ffmpeg = [ffmpeg, '-y', '-i', media_file]
-
-            if filter_str:
-                cmd_ffmpeg.extend(['-vf', filter_str])
-
-            cmd_ffmpeg.extend([
-                '-map', 'v:0',  # Map only video
-                '-c:v', codec,
-                '-crf', quality,
-                '-threads', str(number_of_threads),  # Limit CPU usage
-            ])
-
-            # Apply the encoder speed/preset depending on the codec
-            if codec in ['libx264', 'libx265']:
-                # Use '-preset'
-                cmd_ffmpeg.extend(['-preset', encoder_speed])
-            elif codec == 'libvpx-vp9':
-                # For VP9, use '-cpu-used'
-                cmd_ffmpeg.extend(['-cpu-used', encoder_speed])
-            elif codec == 'libaom-av1':
-                # For AV1, also use '-cpu-used'
-                cmd_ffmpeg.extend(['-cpu-used', encoder_speed])
-
-            # Add pix_fmt if specified for the codec
-            if encoder_options[codec]['pix_fmt']:
-                cmd_ffmpeg.extend(['-pix_fmt', encoder_options[codec]['pix_fmt']])
-
-            # Add encoder-specific options
-            cmd_ffmpeg.extend(encoder_options[codec]['options'])
-
-            # Add tune option if provided
-            if tune_option:
-                cmd_ffmpeg.extend(['-tune', tune_option])
-
-            # Add user-custom parameters if provided
-            if user_custom_ffmpeg.strip():
-                # A simple split() handles space-delimited arguments
-                cmd_ffmpeg.extend(user_custom_ffmpeg.split())
-
-            # Finally, the temporary output
-            cmd_ffmpeg.append(temp_video_file)
-
-            # **Start Video Encoding**
-            console = Console()
-            if ffmpeg_ui.lower() == "compact":
-                null_device = "/dev/null" if os.name != "nt" else "NUL"
-                console.print(f"\n{' '.join(cmd_ffmpeg)}\n", style="bold bright_black", highlight=False)
-                process = FfmpegProcess(cmd_ffmpeg, ffmpeg_log_file=null_device)
-                return_code = process.run()
-                if return_code != 0:
-                    print(f"Error: FFmpeg returned a non-zero exit code ({return_code}). Skipping file.")
-                    continue
-            else:
-                console.print(f"\n{' '.join(cmd_ffmpeg)}\n", style="bold bright_black", highlight=False)
-                try:
-                    subprocess.run(cmd_ffmpeg, check=True)
-                except subprocess.CalledProcessError as e:
-                    print(f"Error encoding video '{media_file}':\n{e.stderr}")
-                    continue
-
-            # **Build Output Filename**
-            basename = os.path.splitext(os.path.basename(media_file))[0]
-            # Replace substrings with codec_display_name
-            for substring in replace_substrings:
-                pattern = re.compile(re.escape(substring), re.IGNORECASE)
-                basename = pattern.sub(codec_display_name, basename)
-            # Remove substrings
-            for substring in remove_substrings:
-                pattern = re.compile(re.escape(substring), re.IGNORECASE)
-                basename = pattern.sub('', basename)
-            output_file = os.path.join(output_subdir, basename + '.mkv')
-
-            # **Build MKVMerge Command to Merge Re-encoded Video with Original Audio/Subtitles**
-            cmd_mkvmerge = [
-                mkvmerge,
-                '-o', output_file,
-                temp_video_file,
-                '--no-video', media_file
-            ]
-            # **Start Merging Process**
-            try:
-                subprocess.run(cmd_mkvmerge, check=True, text=True, capture_output=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Error merging files for {media_file}:\n{e.stderr}")
-                continue
-
-            # Clean up
-            os.remove(temp_video_file)
-            os.remove(media_file)
-            media_dir = os.path.dirname(media_file)
-            delete_empty_media_dirs(media_dir, input_dir, media_extensions)
 
-            # Check again for new stable files
-            remaining_files = wait_for_stable_files(input_dir)
+    run_encode_queue(input_dir, output_dir, media_extensions, settings,
+                     metrics_log=args.metrics_log, metrics_port=args.metrics_port, worker=args.worker)
 
 
 if __name__ == "__main__":
@@ -5,15 +5,35 @@ Matches remuxed media files to finished files by comparing audio and visual
 fingerprints, then renames the remuxed files to match the finished ones.
 """
 
+import argparse
+import hashlib
 import json
 import math
 import os
+import random
+import selectors
 import struct
 import subprocess
 import sys
 import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from functools import lru_cache
 from pathlib import Path
 
+# Optional: NumPy (and SciPy) fingerprint audio clips many times faster than pure Python.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
 
 # ── Config ───────────────────────────────────────────────────────────────────
 
@@ -25,15 +45,32 @@ SAMPLE_FRACTIONS = [0.15, 0.30, 0.50, 0.70, 0.85]
 SAMPLE_WEIGHTS = [1, 2, 3, 2, 1]
 # Seconds of audio to extract per sample point.
 AUDIO_CLIP_SECS = 3
+# Seconds decoded ahead of each clip so the audio decoder (e.g. AC-3) can sync after a fast seek.
+AUDIO_PRE_ROLL_SECS = 2.0
 # Number of RMS energy windows per clip — forms the fingerprint vector.
 AUDIO_WINDOWS = 80
 # Frequency bands (Hz) for per-band RMS fingerprinting at 4 kHz mono.
 # Nyquist is 2000 Hz, so the top band is capped just under.
 # Per-band envelopes let cosine similarity reflect frequency content, not just loudness.
 AUDIO_BANDS = [(100, 500), (500, 1500), (1500, 1900)]
+# Sample rate the audio clips are decoded at.
+AUDIO_SAMPLE_RATE = 4000
+# How audio clips are fingerprinted: "scipy" (lfilter per band), "numpy" (all bands as one
+# FFT filter bank) or "python" (the reference implementation). All give the same
+# fingerprints to within float rounding; the fastest one available is used.
+AUDIO_ENGINE = "scipy" if np is not None and lfilter is not None else "numpy" if np is not None else "python"
 # How many audio streams to try per remuxed file.
 # Remuxes often carry DTS/TrueHD as stream 0 while the finished file uses a different track.
 MAX_AUDIO_STREAMS = 4
+# Extract every clip and frame of a file in one ffmpeg process, each output read from its own
+# pipe. Needs fds passed to the child, which Windows doesn't support — there (and whenever the
+# single process fails) every clip and frame gets its own ffmpeg process instead.
+SINGLE_PROCESS_EXTRACTION = sys.platform != "win32"
+# Files fingerprinted at once (--jobs), and at most this many reading from any one disk at
+# once (--jobs-per-disk) — several ffmpeg processes seeking on one hard drive are slower
+# than one or two.
+FINGERPRINT_JOBS = 8
+FINGERPRINT_JOBS_PER_DISK = 2
 # Maximum duration difference (seconds) for two files to be considered candidates.
 DURATION_TOLERANCE_SECS = 120
 # Cosine similarity threshold for one sample clip to count as a match (0–1).
@@ -47,6 +84,15 @@ DHASH_HEIGHT = 8
 # 4:3 finished file and a 1920x1080 16:9 remux of the same content will both
 # sample the identical central square.
 FRAME_CROP_FRACTION = 0.35
+# Square crop sized by height — robust to horizontal crop differences between versions
+# (e.g. a 1436x1080 4:3 finished file vs a 1920x1080 16:9 remux of the same content).
+# Both sample the same central square.
+FRAME_FILTER = (f"crop=ih*{FRAME_CROP_FRACTION}:ih*{FRAME_CROP_FRACTION},"
+                f"scale={DHASH_WIDTH}:{DHASH_HEIGHT}")
+# Fingerprints are cached in the probe cache database, tagged with a hash of the settings
+# above that shape them — changing any of those recomputes them. Bump this when the
+# fingerprinting code itself changes.
+FINGERPRINT_VERSION = 1
 # Maximum Hamming distance (out of 64 bits) for a frame pair to count as a visual match.
 # Re-encoding (HEVC psy-rd, aq-mode, intra-smoothing) can flip a lot of bits even on
 # identical content, so we're fairly permissive here.
@@ -81,6 +127,108 @@ def clean_path(raw: str) -> str:
     return p
 
 
+def get_probe_cache_path() -> str:
+    """Location of the probe cache shared by all media-toolbox tools."""
+    cache_dir = os.environ.get("MEDIA_TOOLBOX_CACHE")
+    if not cache_dir:
+        if sys.platform == "win32":
+            cache_dir = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "media-toolbox")
+        else:
+            cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                     "media-toolbox")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, "probe-cache.sqlite3")
+
+
+@lru_cache(maxsize=None)
+def init_probe_cache() -> str:
+    """Create the probe cache database and its tables, once per process. Returns its path."""
+    path = get_probe_cache_path()
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                     "mtime_ns INTEGER NOT NULL, data TEXT NOT NULL)")
+    return path
+
+
+def probe_file(filepath: str) -> dict | None:
+    """ffprobe streams/format/chapters for a file, or None on failure.
+
+    One ffprobe call per file, cached in an SQLite database keyed by absolute
+    path and invalidated when the file's size or mtime changes — rescanning a
+    library that hasn't changed never spawns ffprobe.
+    """
+    path = os.path.abspath(filepath)
+    try:
+        st = os.stat(path)
+        with closing(sqlite3.connect(init_probe_cache(), timeout=30)) as conn:
+            row = conn.execute("SELECT size, mtime_ns, data FROM probes WHERE path = ?", (path,)).fetchone()
+            if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                return json.loads(row[2])
+
+            result = subprocess.run(
+                ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-show_chapters",
+                 "-of", "json", path],
+                capture_output=True, text=True, timeout=30
+            )
+            if result.returncode != 0:
+                return None
+            probe = json.loads(result.stdout)
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)",
+                             (path, st.st_size, st.st_mtime_ns, result.stdout))
+            return probe
+    except (OSError, subprocess.SubprocessError, json.JSONDecodeError, sqlite3.Error):
+        # A missing file or ffprobe, a timeout, bad output or a busy cache
+        return None
+
+
+def get_fingerprint_params() -> str:
+    """Hash of every setting that shapes a fingerprint. Cached ones made with other settings are stale."""
+    params = [FINGERPRINT_VERSION, SAMPLE_FRACTIONS, AUDIO_CLIP_SECS, AUDIO_PRE_ROLL_SECS, AUDIO_WINDOWS,
+              AUDIO_BANDS, AUDIO_SAMPLE_RATE, DHASH_WIDTH, DHASH_HEIGHT, FRAME_CROP_FRACTION]
+    return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def init_fingerprint_cache() -> str:
+    """
+    Create the fingerprints table, and drop the fingerprints made with other settings, once
+    per process. Returns the database path.
+    """
+    path = init_probe_cache()
+    with closing(sqlite3.connect(path, timeout=30)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (path TEXT NOT NULL, streams TEXT NOT NULL, "
+                     "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, params TEXT NOT NULL, "
+                     "audio BLOB NOT NULL, video TEXT NOT NULL, PRIMARY KEY (path, streams))")
+        conn.execute("DELETE FROM fingerprints WHERE params != ?", (get_fingerprint_params(),))
+    return path
+
+
+def open_fingerprint_cache() -> sqlite3.Connection:
+    """Connection to the fingerprints table of the probe cache database."""
+    return sqlite3.connect(init_fingerprint_cache(), timeout=30)
+
+
+def pack_audio_fingerprints(audio: list[list[list[float] | None]]) -> bytes:
+    """Audio fingerprints as little-endian doubles, clip after clip. A failed clip is stored as NaNs."""
+    size = AUDIO_WINDOWS * len(AUDIO_BANDS)
+    values = [v for fps in audio for fp in fps for v in (fp if fp is not None else [math.nan] * size)]
+    return struct.pack(f"<{len(values)}d", *values)
+
+
+def unpack_audio_fingerprints(blob: bytes, n_streams: int) -> list[list[list[float] | None]] | None:
+    """Inverse of pack_audio_fingerprints, or None if the blob doesn't hold n_streams streams."""
+    size = AUDIO_WINDOWS * len(AUDIO_BANDS)
+    n_clips = n_streams * len(SAMPLE_FRACTIONS)
+    if len(blob) != n_clips * size * 8:
+        return None
+    values = struct.unpack(f"<{n_clips * size}d", blob)
+    clips = [list(values[i * size:(i + 1) * size]) for i in range(n_clips)]
+    clips = [None if math.isnan(clip[0]) else clip for clip in clips]
+    return [clips[k * len(SAMPLE_FRACTIONS):(k + 1) * len(SAMPLE_FRACTIONS)] for k in range(n_streams)]
+
+
 def get_duration(filepath: str) -> float | None:
     """Duration in seconds from video+audio streams only.
 
@@ -88,16 +236,12 @@ def get_duration(filepath: str) -> float | None:
     so a subtitle track with incorrect/extended timing inflates the reported
     file length. We compute from a/v streams to discard subtitles entirely.
     """
+    probe = probe_file(filepath)
+    if probe is None:
+        return None
     try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "quiet",
-             "-show_entries", "stream=codec_type,duration:stream_tags=DURATION",
-             "-of", "json", filepath],
-            capture_output=True, text=True, timeout=30
-        )
-        streams = json.loads(result.stdout).get("streams", [])
         durations: list[float] = []
-        for s in streams:
+        for s in probe.get("streams", []):
             if s.get("codec_type") not in ("video", "audio"):
                 continue
             d = s.get("duration")
@@ -116,23 +260,23 @@ def get_duration(filepath: str) -> float | None:
                     pass
         if durations:
             return max(durations)
-        # Last-resort fallback: original format-duration query
-        result = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", filepath],
-            capture_output=True, text=True, timeout=30
-        )
-        return float(result.stdout.strip())
+        # Last-resort fallback: container duration
+        return float(probe["format"]["duration"])
     except Exception:
         return None
 
 
-def biquad_bandpass(samples, sample_rate: int,
-                    low_hz: float, high_hz: float) -> list[float]:
-    """Apply an RBJ-cookbook biquad band-pass (constant skirt gain) in Direct Form I.
+def get_audio_channels(filepath: str) -> list[int]:
+    """Channel count of each audio stream, in 0:a:<n> order. Empty if the file can't be probed."""
+    probe = probe_file(filepath)
+    if probe is None:
+        return []
+    return [int(s.get("channels") or 0) for s in probe.get("streams", []) if s.get("codec_type") == "audio"]
 
-    Output is the filtered sample sequence, same length as input.
-    """
+
+def biquad_coefficients(sample_rate: int, low_hz: float,
+                        high_hz: float) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+    """RBJ-cookbook biquad band-pass (constant skirt gain) coefficients as normalized (b, a)."""
     f0 = math.sqrt(low_hz * high_hz)           # geometric center frequency
     bw_octaves = math.log2(high_hz / low_hz)   # bandwidth in octaves
     omega = 2 * math.pi * f0 / sample_rate
@@ -148,8 +292,16 @@ def biquad_bandpass(samples, sample_rate: int,
     a1 = -2 * cos_w
     a2 =  1 - alpha
 
-    b0, b1, b2 = b0 / a0, b1 / a0, b2 / a0
-    a1, a2 = a1 / a0, a2 / a0
+    return (b0 / a0, b1 / a0, b2 / a0), (1.0, a1 / a0, a2 / a0)
+
+
+def biquad_bandpass(samples, sample_rate: int,
+                    low_hz: float, high_hz: float) -> list[float]:
+    """Apply an RBJ-cookbook biquad band-pass (constant skirt gain) in Direct Form I.
+
+    Output is the filtered sample sequence, same length as input.
+    """
+    (b0, b1, b2), (_, a1, a2) = biquad_coefficients(sample_rate, low_hz, high_hz)
 
     out = [0.0] * len(samples)
     x1 = x2 = y1 = y2 = 0.0
@@ -161,55 +313,39 @@ def biquad_bandpass(samples, sample_rate: int,
     return out
 
 
-def extract_audio_clip(filepath: str, timestamp: float,
-                       stream_idx: int | None = None) -> tuple[list[float] | None, str]:
+@lru_cache(maxsize=16)
+def bandpass_filter_bank(length: int, sample_rate: int,
+                         bands: tuple[tuple[float, float], ...]) -> tuple[int, "np.ndarray"]:
+    """FFT size and spectra of the band-pass impulse responses for clips of `length` samples.
+
+    The impulse responses are as long as the clip, so multiplying spectra gives the
+    exact IIR output over the clip — every band filtered in one vectorized step.
     """
-    Extract AUDIO_CLIP_SECS of audio at `timestamp`, downsample to mono 4 kHz,
-    and return (fingerprint, ffmpeg_stderr). fingerprint is None on failure.
+    impulse = [1.0] + [0.0] * (length - 1)
+    responses = np.array([biquad_bandpass(impulse, sample_rate, low_hz, high_hz) for low_hz, high_hz in bands])
+    fft_size = 1 << (2 * length - 1).bit_length()
+    return fft_size, np.fft.rfft(responses, fft_size)
 
-    The fingerprint is per-band RMS envelopes concatenated: for each band in
-    AUDIO_BANDS we IIR-filter the clip, compute AUDIO_WINDOWS RMS values, and
-    normalize the whole vector by a single global peak. Globally normalizing
-    preserves the *relative* energy between bands — without this, two clips
-    with identical loudness contours but different spectral content would
-    still match (each band's envelope normalizes to the same shape).
 
-    Uses fast container seek + a 2-second pre-roll so the audio decoder (e.g. AC-3)
-    has time to sync before we start capturing — avoids all-zero output on long seeks.
-    stream_idx=None lets ffmpeg auto-select; an integer maps to 0:a:<n>.
+def audio_fingerprint(data: bytes, sample_rate: int = AUDIO_SAMPLE_RATE,
+                      engine: str | None = None) -> tuple[list[float] | None, str]:
     """
-    try:
-        pre_roll = 2.0
-        seek_to = max(0.0, timestamp - pre_roll)
-        skip = timestamp - seek_to   # actual gap to discard after fast seek
-
-        audio_args = ["-map", f"0:a:{stream_idx}"] if stream_idx is not None else ["-vn"]
-        sample_rate = 4000
+    Fingerprint raw mono s16le PCM: per-band RMS envelopes, normalized by their global peak
+    (see extract_audio_clips). Returns (fingerprint, reason) — fingerprint is None and
+    reason says why when the clip is too short or silent. engine overrides AUDIO_ENGINE.
+    """
+    engine = engine or AUDIO_ENGINE
+    n = len(data) // 2
+    if n < AUDIO_WINDOWS:
+        return None, f"only {n} samples (need {AUDIO_WINDOWS})"
+    ws = n // AUDIO_WINDOWS
 
-        cmd = ["ffmpeg", "-y",
-               "-ss", str(seek_to), "-i", filepath,   # fast container seek
-               "-ss", str(skip),                       # decoder-accurate skip within stream
-               "-t", str(AUDIO_CLIP_SECS),
-               *audio_args,
-               "-ac", "1",     # mono
-               "-ar", str(sample_rate),  # 4 kHz — sufficient for fingerprinting
-               "-f", "s16le",  # raw signed 16-bit LE PCM → stdout
-               "-"]
-        result = subprocess.run(cmd, capture_output=True, timeout=30)
-        stderr = result.stderr.decode(errors="replace")
-        cmd_str = " ".join(cmd)
-        data = result.stdout
-        n = len(data) // 2
-        if n < AUDIO_WINDOWS:
-            return None, f"only {n} samples (need {AUDIO_WINDOWS})\n$ {cmd_str}\n{stderr}"
+    if engine == "python":
         samples = struct.unpack(f"<{n}h", data[:n * 2])
-        ws = n // AUDIO_WINDOWS
-
         # Silence guard on the raw signal — cheap and catches all-zero decoder output
         raw_peak = max(abs(s) for s in samples)
         if raw_peak < 1:
-            return None, f"audio is silence (peak={raw_peak})\n$ {cmd_str}\n{stderr}"
-
+            return None, f"audio is silence (peak={raw_peak})"
         fingerprint: list[float] = []
         for low_hz, high_hz in AUDIO_BANDS:
             filtered = biquad_bandpass(samples, sample_rate, low_hz, high_hz)
@@ -219,10 +355,109 @@ def extract_audio_clip(filepath: str, timestamp: float,
             )
         peak = max(fingerprint)
         if peak < 1e-9:
-            return None, f"audio is silence after filtering\n$ {cmd_str}\n{stderr}"
+            return None, "audio is silence after filtering"
         return [v / peak for v in fingerprint], ""
+
+    samples = np.frombuffer(data, dtype="<i2", count=n).astype(np.float64)
+    raw_peak = int(np.abs(samples).max())
+    if raw_peak < 1:
+        return None, f"audio is silence (peak={raw_peak})"
+    if engine == "scipy":
+        filtered = np.stack([lfilter(*biquad_coefficients(sample_rate, low_hz, high_hz), samples)
+                             for low_hz, high_hz in AUDIO_BANDS])
+    else:
+        fft_size, bank = bandpass_filter_bank(n, sample_rate, tuple(AUDIO_BANDS))
+        filtered = np.fft.irfft(bank * np.fft.rfft(samples, fft_size), fft_size)[:, :n]
+    # One row per band, one window per row of the reshaped envelope
+    windows = filtered[:, :ws * AUDIO_WINDOWS].reshape(len(AUDIO_BANDS), AUDIO_WINDOWS, ws)
+    fingerprint = np.sqrt(np.mean(windows * windows, axis=2)).ravel()
+    peak = fingerprint.max()
+    if peak < 1e-9:
+        return None, "audio is silence after filtering"
+    return (fingerprint / peak).tolist(), ""
+
+
+def run_audio_extraction(filepath: str, seek_to: float, skip: float,
+                         stream_indices: list[int]) -> tuple[list[bytes], bool, str]:
+    """
+    Run one ffmpeg process for the clip of every stream in `stream_indices` (see
+    extract_audio_clips). Returns (mono s16le PCM per stream, whether ffmpeg succeeded,
+    the command line and stderr for diagnostics).
+    """
+    sample_rate = AUDIO_SAMPLE_RATE
+    n_streams = len(stream_indices)
+    graph = ";".join(f"[0:a:{si}]aresample={sample_rate},aformat=sample_fmts=s16:channel_layouts=mono[a{k}]"
+                     for k, si in enumerate(stream_indices))
+    if n_streams > 1:
+        graph += ";" + "".join(f"[a{k}]" for k in range(n_streams)) + f"amerge=inputs={n_streams}[a]"
+    else:
+        graph = graph.replace("[a0]", "[a]")
+
+    cmd = ["ffmpeg", "-y",
+           "-ss", str(seek_to), "-i", filepath,   # fast container seek
+           "-filter_complex", graph,               # mono 4 kHz per stream, one channel each
+           "-map", "[a]",
+           "-ss", str(skip),                       # decoder-accurate skip within stream
+           "-t", str(AUDIO_CLIP_SECS),
+           "-f", "s16le",  # raw signed 16-bit LE PCM → stdout
+           "-"]
+    result = subprocess.run(cmd, capture_output=True, timeout=30)
+    diagnostics = f"$ {' '.join(cmd)}\n{result.stderr.decode(errors='replace')}"
+    # Interleaved samples — every n_streams-th one belongs to the same stream
+    data = result.stdout[:len(result.stdout) - len(result.stdout) % (2 * n_streams)]
+    samples = memoryview(data).cast("h")
+    return [samples[k::n_streams].tobytes() for k in range(n_streams)], result.returncode == 0, diagnostics
+
+
+def extract_audio_clips(filepath: str, timestamp: float,
+                        stream_indices: list[int]) -> tuple[list[list[float] | None], str]:
+    """
+    Extract AUDIO_CLIP_SECS of audio at `timestamp` from every stream in `stream_indices`
+    (0:a:<n> indexes), downsample each to mono 4 kHz, and return (one fingerprint per
+    stream, reasons). A fingerprint is None on failure and the reasons say why.
+
+    The fingerprint is per-band RMS envelopes concatenated: for each band in
+    AUDIO_BANDS we IIR-filter the clip, compute AUDIO_WINDOWS RMS values, and
+    normalize the whole vector by a single global peak. Globally normalizing
+    preserves the *relative* energy between bands — without this, two clips
+    with identical loudness contours but different spectral content would
+    still match (each band's envelope normalizes to the same shape).
+
+    Uses fast container seek + a 2-second pre-roll so the audio decoder (e.g. AC-3)
+    has time to sync before we start capturing — avoids all-zero output on long seeks.
+    All streams come from that one seek and demux: each is downmixed on its own, then
+    they're merged as the channels of one PCM stream on stdout and split apart again.
+    A decode error in one stream fails the merged run, and amerge stops at the shortest
+    stream, so if it fails or comes back short every stream is extracted on its own.
+    """
+    if not stream_indices:
+        return [], ""
+    try:
+        seek_to = max(0.0, timestamp - AUDIO_PRE_ROLL_SECS)
+        skip = timestamp - seek_to   # actual gap to discard after fast seek
+
+        clips, ok, diagnostics = run_audio_extraction(filepath, seek_to, skip, stream_indices)
+        stream_diagnostics = [diagnostics] * len(stream_indices)
+        full_length = 2 * int(AUDIO_CLIP_SECS * AUDIO_SAMPLE_RATE * 0.99)
+        if len(stream_indices) > 1 and (not ok or len(clips[0]) < full_length):
+            clips, stream_diagnostics = [], []
+            for si in stream_indices:
+                clip, _, diagnostics = run_audio_extraction(filepath, seek_to, skip, [si])
+                clips += clip
+                stream_diagnostics.append(diagnostics)
+
+        fingerprints: list[list[float] | None] = []
+        reasons: list[str] = []
+        failed_runs: dict[str, None] = {}   # diagnostics of the runs behind the failures, in order
+        for si, clip, diagnostics in zip(stream_indices, clips, stream_diagnostics):
+            fingerprint, reason = audio_fingerprint(clip, AUDIO_SAMPLE_RATE)
+            fingerprints.append(fingerprint)
+            if fingerprint is None:
+                reasons.append(f"stream {si}: {reason}")
+                failed_runs[diagnostics] = None
+        return fingerprints, "\n".join(reasons + list(failed_runs))
     except Exception as e:
-        return None, str(e)
+        return [None] * len(stream_indices), str(e)
 
 
 def extract_video_frame_hash(filepath: str, timestamp: float) -> int | None:
@@ -235,34 +470,32 @@ def extract_video_frame_hash(filepath: str, timestamp: float) -> int | None:
     to produce a binary hash that is robust to re-encoding, resolution, and color changes.
     """
     try:
-        crop = FRAME_CROP_FRACTION
-        # Square crop sized by height — robust to horizontal crop differences
-        # between versions (e.g. a 1436x1080 4:3 finished file vs a 1920x1080
-        # 16:9 remux of the same content). Both sample the same central square.
-        vf = f"crop=ih*{crop}:ih*{crop},scale={DHASH_WIDTH}:{DHASH_HEIGHT}"
         cmd = ["ffmpeg", "-y",
                "-ss", str(timestamp), "-i", filepath,
                "-vframes", "1",
-               "-vf", vf,
+               "-vf", FRAME_FILTER,
                "-pix_fmt", "gray",
                "-f", "rawvideo",
                "-"]
         result = subprocess.run(cmd, capture_output=True, timeout=30)
-        data = result.stdout
-        expected = DHASH_WIDTH * DHASH_HEIGHT
-        if len(data) < expected:
-            return None
-        bits = 0
-        for row in range(DHASH_HEIGHT):
-            for col in range(DHASH_WIDTH - 1):
-                idx = row * DHASH_WIDTH + col
-                if data[idx] > data[idx + 1]:
-                    bits |= 1 << (row * (DHASH_WIDTH - 1) + col)
-        return bits
+        return frame_hash(result.stdout)
     except Exception:
         return None
 
 
+def frame_hash(data: bytes) -> int | None:
+    """dHash of a raw DHASH_WIDTH x DHASH_HEIGHT gray frame, or None if the frame is incomplete."""
+    if len(data) < DHASH_WIDTH * DHASH_HEIGHT:
+        return None
+    bits = 0
+    for row in range(DHASH_HEIGHT):
+        for col in range(DHASH_WIDTH - 1):
+            idx = row * DHASH_WIDTH + col
+            if data[idx] > data[idx + 1]:
+                bits |= 1 << (row * (DHASH_WIDTH - 1) + col)
+    return bits
+
+
 def hamming_distance(a: int, b: int) -> int:
     """Count differing bits between two integers."""
     return bin(a ^ b).count('1')
@@ -302,24 +535,280 @@ def collect_media_files(folder: str) -> list[Path]:
     ]
 
 
-def compute_fingerprints(filepath: Path, duration: float, label: str = "",
-                         stream_idx: int | None = None) -> list[list[float] | None]:
-    """Sample audio at each SAMPLE_FRACTIONS position; return one envelope per fraction."""
-    fps: list[list[float] | None] = []
+def compute_fingerprints(filepath: Path, duration: float,
+                         stream_indices: list[int]) -> list[list[list[float] | None]]:
+    """Sample audio at each SAMPLE_FRACTIONS position; return one envelope per fraction for each stream."""
+    fps: list[list[list[float] | None]] = [[] for _ in stream_indices]
     for frac in SAMPLE_FRACTIONS:
         ts = max(0.0, duration * frac - AUDIO_CLIP_SECS / 2)
-        fp, _ = extract_audio_clip(str(filepath), ts, stream_idx)
-        fps.append(fp)
-    if label:
-        ok = sum(1 for fp in fps if fp is not None)
-        status = f"{GREEN}OK{RESET} ({ok}/{len(fps)} clips)" if ok else f"{RED}FAIL{RESET}"
-        print(f"  {DIM}[{status}{DIM}]{RESET} {label}")
+        clips, _ = extract_audio_clips(str(filepath), ts, stream_indices)
+        for stream_fps, fp in zip(fps, clips):
+            stream_fps.append(fp)
     return fps
 
 
+def extract_samples(filepath: str, duration: float,
+                    audio_streams: list[int]) -> tuple[list[list[list[float] | None]], list[int | None]] | None:
+    """
+    Extract every audio clip and video frame of a file in one ffmpeg process.
+
+    Each sample point gets its own fast-seeked input — one for the audio clip (with the same
+    pre-roll as extract_audio_clips) and one for the frame — so the file is opened by a single
+    process and each seek is demuxed once for all of `audio_streams` (0:a:<n> indexes). Every
+    clip and frame is written to its own pipe and read back concurrently.
+
+    Returns (fingerprints per stream, one per fraction; frame hashes, one per fraction), or
+    None if ffmpeg failed outright so the caller can fall back to one process per clip.
+    """
+    probe = probe_file(filepath) or {}
+    has_video = any(s.get("codec_type") == "video" for s in probe.get("streams", []))
+    inputs: list[list[str]] = []
+    outputs: list[tuple[str, int, int, list[str]]] = []   # (kind, stream, fraction, args)
+    for i, frac in enumerate(SAMPLE_FRACTIONS):
+        if audio_streams:
+            ts = max(0.0, duration * frac - AUDIO_CLIP_SECS / 2)
+            seek_to = max(0.0, ts - AUDIO_PRE_ROLL_SECS)
+            skip = ts - seek_to
+            inputs.append(["-ss", str(seek_to), "-t", str(skip + AUDIO_CLIP_SECS), "-i", filepath])
+            for k, si in enumerate(audio_streams):
+                outputs.append(("audio", k, i, ["-map", f"{len(inputs) - 1}:a:{si}",
+                                                "-ss", str(skip), "-t", str(AUDIO_CLIP_SECS),
+                                                "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-f", "s16le"]))
+        if has_video:
+            inputs.append(["-ss", str(duration * frac), "-i", filepath])
+            outputs.append(("video", 0, i, ["-map", f"{len(inputs) - 1}:v:0", "-frames:v", "1",
+                                            "-vf", FRAME_FILTER, "-pix_fmt", "gray", "-f", "rawvideo"]))
+    if not outputs:
+        return [[None] * len(SAMPLE_FRACTIONS) for _ in audio_streams], [None] * len(SAMPLE_FRACTIONS)
+
+    cmd = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error", *(arg for args in inputs for arg in args)]
+    pipes: list[tuple[int, int]] = []
+    try:
+        for *_, args in outputs:
+            pipes.append(os.pipe())
+            cmd += [*args, f"pipe:{pipes[-1][1]}"]
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, pass_fds=[w for _, w in pipes])
+    except OSError:
+        for r, w in pipes:
+            os.close(r)
+            os.close(w)
+        return None
+
+    # Drain every output (and stderr) as ffmpeg writes them — a full pipe that nobody
+    # reads would stall the whole process.
+    buffers: list[list[bytes]] = [[] for _ in outputs]
+    stderr: list[bytes] = []
+    deadline = time.monotonic() + 30 * len(SAMPLE_FRACTIONS)
+    with selectors.DefaultSelector() as selector:
+        for j, (r, w) in enumerate(pipes):
+            os.close(w)
+            selector.register(r, selectors.EVENT_READ, buffers[j])
+        selector.register(proc.stderr, selectors.EVENT_READ, stderr)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                proc.kill()
+                break
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    key.data.append(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+    for r, _ in pipes:
+        os.close(r)
+    proc.stderr.close()
+    returncode = proc.wait()
+
+    data = [b"".join(chunks) for chunks in buffers]
+    if returncode != 0 and not any(data):
+        return None
+    audio: list[list[list[float] | None]] = [[None] * len(SAMPLE_FRACTIONS) for _ in audio_streams]
+    hashes: list[int | None] = [None] * len(SAMPLE_FRACTIONS)
+    for (kind, k, i, _), clip in zip(outputs, data):
+        if kind == "audio":
+            audio[k][i] = audio_fingerprint(clip)[0]
+        else:
+            hashes[i] = frame_hash(clip)
+    return audio, hashes
+
+
+def fingerprint_file(filepath: Path, duration: float, audio_streams: list[int],
+                     disk_slot: threading.Semaphore | None = None) -> tuple[list[list[list[float] | None]],
+                                                                           list[int | None]]:
+    """Audio fingerprints for each of `audio_streams` plus the frame hashes of one file.
+
+    Kept in the probe cache database, keyed by absolute path, audio streams, size, mtime
+    and get_fingerprint_params() — an unchanged file is only ever fingerprinted once.
+    Extraction (not a cache hit) waits for `disk_slot` when one is given.
+    """
+    path = os.path.abspath(filepath)
+    streams = json.dumps(audio_streams)
+    params = get_fingerprint_params()
+    try:
+        st = os.stat(path)
+        with closing(open_fingerprint_cache()) as conn:
+            row = conn.execute("SELECT size, mtime_ns, params, audio, video FROM fingerprints "
+                               "WHERE path = ? AND streams = ?", (path, streams)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime_ns, params):
+            audio = unpack_audio_fingerprints(row[3], len(audio_streams))
+            if audio is not None:
+                return audio, json.loads(row[4])
+    except (OSError, ValueError, sqlite3.Error):
+        st = None
+
+    with disk_slot or nullcontext():
+        samples = extract_samples(str(filepath), duration, audio_streams) if SINGLE_PROCESS_EXTRACTION else None
+        if samples is None:
+            samples = compute_fingerprints(filepath, duration, audio_streams), compute_video_hashes(filepath, duration)
+    audio, vhashes = samples
+
+    # Nothing extracted at all is more likely a transient problem than the file itself — try again next run
+    if st is not None and (any(fp is not None for fps in audio for fp in fps) or any(h is not None for h in vhashes)):
+        try:
+            with closing(open_fingerprint_cache()) as conn:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO fingerprints (path, streams, size, mtime_ns, params, "
+                                 "audio, video) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (path, streams, st.st_size, st.st_mtime_ns, params,
+                                  pack_audio_fingerprints(audio), json.dumps(vhashes)))
+        except sqlite3.Error:
+            pass
+    return audio, vhashes
+
+
+def fingerprint_files(files: list[Path], durations: dict[Path, float | None], all_streams: bool,
+                      jobs: int, jobs_per_disk: int) -> dict[Path, tuple[list[list[list[float] | None]],
+                                                                           list[int | None]]]:
+    """
+    Fingerprint `files` on a pool of `jobs` threads, at most `jobs_per_disk` of them extracting
+    from the same disk at once. all_streams takes up to MAX_AUDIO_STREAMS audio streams per file
+    (remuxes), otherwise only the one ffmpeg would pick by itself: the one with the most channels.
+
+    Prints one status line per file as results come in, always in the order of `files`.
+    Files with an unknown duration get empty fingerprints.
+    """
+    disk_slots: dict[int, threading.Semaphore] = {}
+    for f in files:
+        try:
+            disk_slots.setdefault(os.stat(f).st_dev, threading.Semaphore(jobs_per_disk))
+        except OSError:
+            pass
+
+    def fingerprint(f: Path):
+        channels = get_audio_channels(str(f))
+        if all_streams:
+            streams = list(range(min(len(channels), MAX_AUDIO_STREAMS)))
+        else:
+            streams = [channels.index(max(channels))] if channels else []
+        try:
+            slot = disk_slots.get(os.stat(f).st_dev)
+        except OSError:
+            slot = None
+        return fingerprint_file(f, durations[f], streams, slot)
+
+    results: dict[Path, tuple[list[list[list[float] | None]], list[int | None]]] = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {f: executor.submit(fingerprint, f) for f in files if durations.get(f) is not None}
+        for i, f in enumerate(files, 1):
+            progress = f"{DIM}{i:>{len(str(len(files)))}}/{len(files)}{RESET}"
+            if f not in futures:
+                print(f"  {progress} {RED}SKIP{RESET} {f.name} — duration unknown")
+                results[f] = ([], [])
+                continue
+            results[f] = futures[f].result()
+            status = fingerprint_status(*results[f], count_streams=all_streams)
+            print(f"  {progress} {DIM}[{status}{DIM}]{RESET} {f.name}")
+    return results
+
+
+def fingerprint_status(audio_streams: list[list[list[float] | None]], vhashes: list[int | None],
+                       count_streams: bool = False) -> str:
+    """One-line result of fingerprint_file, e.g. 'OK (5/5 clips, 2 streams | 5/5 frames)'."""
+    best_clips = max((sum(1 for fp in fps if fp is not None) for fps in audio_streams), default=0)
+    n_streams = sum(1 for fps in audio_streams if any(fp is not None for fp in fps))
+    stream_word = "stream" if n_streams == 1 else "streams"
+    streams = f", {n_streams} {stream_word}" if count_streams else ""
+    a_status = f"{best_clips}/{len(SAMPLE_FRACTIONS)} clips{streams}" if best_clips else "no audio"
+    v_ok = sum(1 for h in vhashes if h is not None)
+    v_status = f"{v_ok}/{len(SAMPLE_FRACTIONS)} frames"
+    return f"{GREEN}OK{RESET} ({a_status} | {v_status})" if (best_clips or v_ok) else f"{RED}FAIL{RESET}"
+
+
+# ── Benchmark ────────────────────────────────────────────────────────────────
+
+def synthetic_clip(seed: int) -> bytes:
+    """AUDIO_CLIP_SECS of deterministic test audio: a few tones under moving envelopes, plus noise."""
+    rng = random.Random(seed)
+    tones = [(rng.uniform(120, 1850), rng.uniform(0.2, 2.0), rng.uniform(0.05, 0.3)) for _ in range(4)]
+    n = AUDIO_CLIP_SECS * AUDIO_SAMPLE_RATE
+    samples = []
+    for i in range(n):
+        t = i / AUDIO_SAMPLE_RATE
+        v = sum(amp * (0.6 + 0.4 * math.sin(2 * math.pi * env_hz * t)) * math.sin(2 * math.pi * hz * t)
+                for hz, env_hz, amp in tones)
+        samples.append(max(-32768, min(32767, int((v + rng.gauss(0, 0.02)) * 32767))))
+    return struct.pack(f"<{n}h", *samples)
+
+
+def run_benchmark():
+    """Time every available fingerprint engine on the clips of one remux and compare their output."""
+    clips = [synthetic_clip(seed) for seed in range(len(SAMPLE_FRACTIONS) * MAX_AUDIO_STREAMS)]
+    engines = ["python"]
+    if np is not None:
+        engines.append("numpy")
+        if lfilter is not None:
+            engines.append("scipy")
+
+    print(f"\n{BOLD}Audio fingerprint benchmark{RESET}")
+    print(f"{DIM}  {AUDIO_CLIP_SECS}s clips x {len(SAMPLE_FRACTIONS)} samples x {MAX_AUDIO_STREAMS} streams "
+          f"at {AUDIO_SAMPLE_RATE} Hz, {len(AUDIO_BANDS)} bands{RESET}\n")
+    reference: list[list[float]] = []
+    reference_secs = 0.0
+    for engine in engines:
+        audio_fingerprint(clips[0], engine=engine)  # warm-up, e.g. the numpy filter bank
+        start = time.perf_counter()
+        fingerprints = [audio_fingerprint(clip, engine=engine)[0] for clip in clips]
+        secs = time.perf_counter() - start
+        if not reference:
+            reference, reference_secs = fingerprints, secs
+        max_diff = max(abs(a - b) for fp, ref in zip(fingerprints, reference) for a, b in zip(fp, ref))
+        min_sim = min(audio_similarity(fp, ref) for fp, ref in zip(fingerprints, reference))
+        default = f" {CYAN}(default){RESET}" if engine == AUDIO_ENGINE else ""
+        print(f"  {engine:<7} {secs * 1000:8.1f} ms  {GREEN}{reference_secs / secs:6.1f}x{RESET}  "
+              f"{DIM}max diff {max_diff:.1e}, min similarity {min_sim:.9f}{RESET}{default}")
+    if np is None:
+        print(f"\n{YELLOW}Install numpy (and scipy) for the faster engines.{RESET}")
+    print()
+
+
 # ── Main ─────────────────────────────────────────────────────────────────────
 
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Match remuxed media files to finished files by audio and "
+                                                 "visual fingerprints, and rename them.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Time the audio fingerprint engines on synthetic clips and exit.")
+    parser.add_argument("--jobs", type=int, default=FINGERPRINT_JOBS,
+                        help=f"Files to fingerprint at once (default: {FINGERPRINT_JOBS}).")
+    parser.add_argument("--jobs-per-disk", type=int, default=FINGERPRINT_JOBS_PER_DISK,
+                        help=f"Files to fingerprint at once from any one disk "
+                             f"(default: {FINGERPRINT_JOBS_PER_DISK}).")
+    args = parser.parse_args()
+    if args.jobs < 1 or args.jobs_per_disk < 1:
+        parser.error("--jobs and --jobs-per-disk must be at least 1")
+    return args
+
+
 def main():
+    args = parse_arguments()
+    if args.benchmark:
+        run_benchmark()
+        return
+
     print(f"\n{BOLD}{'═' * 60}{RESET}")
     print(f"{BOLD}  Media File Matcher & Renamer{RESET}")
     print(f"{BOLD}{'═' * 60}{RESET}")
@@ -370,24 +859,10 @@ def main():
         print(f"  {DIM}[{fmt_dur(d):>7}]{RESET} {f.name}")
 
     # ── Fingerprint finished files (audio + video) ─────────────────────────
-    print(f"\n{BOLD}Fingerprinting finished files (audio)...{RESET}")
-    finished_audio: dict[Path, list] = {}
-    for f in finished_files:
-        dur = finished_durations[f]
-        if dur is None:
-            print(f"  {RED}SKIP{RESET} {f.name} — duration unknown")
-            finished_audio[f] = []
-        else:
-            finished_audio[f] = compute_fingerprints(f, dur, f.name)
-
-    print(f"\n{BOLD}Fingerprinting finished files (video)...{RESET}")
-    finished_video: dict[Path, list[int | None]] = {}
-    for f in finished_files:
-        dur = finished_durations[f]
-        if dur is None:
-            finished_video[f] = []
-        else:
-            finished_video[f] = compute_video_hashes(f, dur, f.name)
+    print(f"\n{BOLD}Fingerprinting finished files (audio + video)...{RESET}")
+    finished = fingerprint_files(finished_files, finished_durations, False, args.jobs, args.jobs_per_disk)
+    finished_audio: dict[Path, list] = {f: audio[0] if audio else [] for f, (audio, _) in finished.items()}
+    finished_video: dict[Path, list[int | None]] = {f: vhashes for f, (_, vhashes) in finished.items()}
 
     # ── Process remuxed folders (loop) ──────────────────────────────────
     first_remuxed_run = True
@@ -424,10 +899,22 @@ def main():
                 cand_word = "candidate" if len(cands) == 1 else "candidates"
                 print(f"  {DIM}{fin_path.name}:{RESET} {CYAN}{len(cands)}{RESET} {cand_word}")
 
-            # ── Verify: fingerprint candidates and score with combined matching ───
+            # ── Fingerprint every candidate of a finished file that has fingerprints ──
+            print(f"\n{BOLD}Fingerprinting remuxed candidates (audio + video)...{RESET}")
+            wanted = {rem_file for fin_path in finished_files
+                      if any(fp is not None for fp in finished_audio[fin_path])
+                      or any(h is not None for h in finished_video[fin_path])
+                      for rem_file in candidates_for[fin_path]}
+            remuxed = fingerprint_files([f for f in remuxed_files if f in wanted], remuxed_durations, True,
+                                        args.jobs, args.jobs_per_disk)
+            rem_cache: dict[Path, tuple[list[list], list[int | None]]] = {
+                f: ([fps for fps in audio if any(fp is not None for fp in fps)], vhashes)
+                for f, (audio, vhashes) in remuxed.items()
+            }
+
+            # ── Verify: score candidates with combined matching ─────────────────
             print(f"\n{BOLD}Verifying candidates by audio + visual fingerprint...{RESET}")
             matches: list[tuple[Path, Path, int, int, int, float]] = []
-            rem_cache: dict[Path, tuple[list[list], list[int | None]]] = {}
 
             # Collect every passing (fin, rem) pair so we can do greedy bipartite
             # assignment instead of per-finished "take your best" + dedupe (which
@@ -457,28 +944,6 @@ def main():
                     if rem_dur is None:
                         continue
 
-                    if rem_file not in rem_cache:
-                        all_streams: list[list] = []
-                        for si in range(MAX_AUDIO_STREAMS):
-                            fps = compute_fingerprints(rem_file, rem_dur, stream_idx=si)
-                            if not any(fp is not None for fp in fps):
-                                break
-                            all_streams.append(fps)
-                        n_streams = len(all_streams)
-                        best_clips = max((sum(1 for fp in s if fp is not None)
-                                          for s in all_streams), default=0)
-                        stream_word = "stream" if n_streams == 1 else "streams"
-                        a_status = (f"{best_clips}/{len(SAMPLE_FRACTIONS)} clips"
-                                    f", {n_streams} {stream_word}" if n_streams else "no audio")
-
-                        vhashes = compute_video_hashes(rem_file, rem_dur)
-                        v_ok = sum(1 for h in vhashes if h is not None)
-                        v_status = f"{v_ok}/{len(SAMPLE_FRACTIONS)} frames"
-
-                        status = f"{GREEN}OK{RESET} ({a_status} | {v_status})" if (n_streams or v_ok) else f"{RED}FAIL{RESET}"
-                        print(f"  {DIM}[{status}{DIM}]{RESET} {rem_file.name}")
-                        rem_cache[rem_file] = (all_streams, vhashes)
-
                     rem_audio_streams, rem_vhashes = rem_cache[rem_file]
 
                     # Video evidence is only meaningful when both files actually produced